@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+TIMELINE_DIR = os.path.join(BENCHMARK_DIR, os.pardir, 'timeline')
+sys.path.insert(0, TIMELINE_DIR)
+
+import gencollect
+import main as timeline_main
+from timelineindex import TimelineIndex
+from utils import parse_epoch
+import writers
+
+"""
+Benchmarks for the parsers and the rest of the path from cbcollect to
+output.
+
+Synthetic collects are generated with gencollect, then each stage is timed
+on its own: every parser in LOG_MODULES, parse_zip_file, decoding and
+combining stored timelines, to_dict, the compact encoding, indexed queries
+and each output format. Startup is timed in a fresh interpreter, both
+importing main and a whole run of main.py on a single collect. The best of
+several runs is taken for each.
+
+Results are written as JSON and can be compared against the results of an
+earlier run, e.g.
+
+    bench.py --output baseline.json
+    (make changes)
+    bench.py --baseline baseline.json
+"""
+
+# Measures of throughput in order of preference when comparing runs
+RATES = ('mb_per_s', 'lines_per_s', 'events_per_s')
+
+MEGABYTE = 1048576.0
+
+TIMESTAMPS = 100000
+
+QUERIES = 1000
+
+MAIN = os.path.join(TIMELINE_DIR, 'main.py')
+
+
+class NullWriter(object):
+    """A file object that counts what is written to it"""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+
+def best_time(func, repeat):
+    """Run func repeat times, returning the shortest time taken and the
+    result of the last run.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def measure(seconds, size=None, lines=None, events=None):
+    result = {'seconds': seconds}
+    for name, count, rate, scale in (('bytes', size, 'mb_per_s', MEGABYTE),
+                                     ('lines', lines, 'lines_per_s', 1),
+                                     ('events', events, 'events_per_s', 1)):
+        if count is not None:
+            result[name] = count
+            result[rate] = count / scale / seconds if seconds else None
+    return result
+
+
+def read_members(zip_file):
+    """Return the node name and {logname: data} of the logs in a collect
+    that one of the LOG_MODULES parses.
+    """
+    members = {}
+    node_name = None
+    with zipfile.ZipFile(zip_file, 'r') as ci:
+        for info in ci.infolist():
+            logname = info.filename.split('/')[-1]
+            if node_name is None:
+                node_name = timeline_main.extract_nodename(
+                    info.filename.split('/')[0], None)
+            if logname in timeline_main.LOG_MODULES:
+                members[logname] = ci.read(info)
+    return node_name, members
+
+
+def parse_log(parser, data, node_name):
+    timeline = timeline_main.Timeline()
+    timeline.default_node_name = node_name
+    parser(io.BytesIO(data), timeline)
+    return timeline
+
+
+def bench_parsers(zips, repeat):
+    results = {}
+    node_name, members = read_members(zips[0])
+    for logname, data in sorted(members.iteritems()):
+        parser = timeline_main.get_parser(logname)
+        seconds, timeline = best_time(
+            lambda: parse_log(parser, data, node_name), repeat)
+        results['parser.{}'.format(parser.__name__)] = measure(
+            seconds, len(data), data.count('\n'), len(timeline.events))
+    return results
+
+
+def bench_parse_zip_file(zips, repeat):
+    size = 0
+    lines = 0
+    for zip_file in zips:
+        _, members = read_members(zip_file)
+        size += sum(len(data) for data in members.itervalues())
+        lines += sum(data.count('\n') for data in members.itervalues())
+    seconds, timelines = best_time(
+        lambda: [timeline_main.parse_zip_file(zip_file) for zip_file in zips],
+        repeat)
+    events = sum(len(timeline.events) for timeline in timelines)
+    return {'parse_zip_file': measure(seconds, size, lines, events)}, \
+        timelines
+
+
+def bench_timestamps(timelines, repeat):
+    results = {}
+    events = [event for timeline in timelines for event in timeline.events]
+    stamps = [events[i % len(events)].timestamp.isoformat()
+              for i in xrange(TIMESTAMPS)]
+    seconds, _ = best_time(lambda: [parse_epoch(stamp) for stamp in stamps],
+                           repeat)
+    results['timestamps.parse_epoch'] = measure(seconds, events=len(stamps))
+    try:
+        from dateutil import parser as date_parser
+    except ImportError:
+        pass
+    else:
+        # dateutil is far slower, so a tenth of the timestamps will do
+        sample = stamps[:len(stamps) // 10]
+        seconds, _ = best_time(
+            lambda: [date_parser.parse(stamp) for stamp in sample], repeat)
+        results['timestamps.dateutil'] = measure(seconds, events=len(sample))
+    return results
+
+
+def bench_combine(timelines, repeat):
+    results = {}
+    docs = [json.loads(json.dumps({'events': [event.to_dict() for event
+                                              in timeline.events]}))
+            for timeline in timelines]
+    events = sum(len(doc['events']) for doc in docs)
+    seconds, decoded = best_time(
+        lambda: [timeline_main.decode_timeline(doc) for doc in docs], repeat)
+    results['decode_timeline'] = measure(seconds, events=events)
+
+    seconds, combined = best_time(
+        lambda: timeline_main.combine_timelines(decoded), repeat)
+    results['combine_timelines'] = measure(seconds, events=events)
+
+    compact = [json.loads(timeline.to_compact()) for timeline in timelines]
+    seconds, _ = best_time(
+        lambda: [timeline.to_compact() for timeline in timelines], repeat)
+    results['to_compact'] = measure(seconds, events=events)
+    seconds, _ = best_time(
+        lambda: [timeline_main.decode_timeline(doc) for doc in compact],
+        repeat)
+    results['from_compact'] = measure(seconds, events=events)
+    return results, combined
+
+
+def bench_query(timeline, repeat):
+    """Time building a TimelineIndex, then queries for the events of one
+    node and type within a tenth of the timeline.
+    """
+    results = {}
+    timeline.sort()
+    events = timeline.events
+    seconds, index = best_time(lambda: TimelineIndex(events), repeat)
+    results['query.index'] = measure(seconds, events=len(events))
+
+    rand = random.Random(0)
+    span = (events[-1].epoch - events[0].epoch) // 10
+    queries = []
+    for _ in xrange(QUERIES):
+        event = rand.choice(events)
+        queries.append((event.epoch, event.epoch + span, [event.node_name],
+                        [event.type]))
+    seconds, _ = best_time(lambda: [index.query(*query) for query in queries],
+                           repeat)
+    results['query.node_type'] = measure(seconds, events=len(queries))
+    return results
+
+
+def bench_outputs(timeline, repeat):
+    results = {}
+    events = len(timeline.events)
+    seconds, _ = best_time(timeline.to_dict, repeat)
+    results['to_dict'] = measure(seconds, events=events)
+    for output_format in sorted(writers.WRITERS):
+        out = NullWriter()
+        seconds, _ = best_time(
+            lambda: writers.write_timeline(timeline, output_format, out),
+            repeat)
+        results['output.{}'.format(output_format)] = measure(
+            seconds, out.size // repeat, events=events)
+    return results
+
+
+def bench_startup(zips, repeat):
+    """Time a fresh interpreter importing main, and running main.py on the
+    smallest collect, so that slow imports show up as regressions.
+    """
+    results = {}
+    devnull = open(os.devnull, 'w')
+    smallest = min(zips, key=os.path.getsize)
+    for name, args in (('startup.import', ['-c', 'import main']),
+                       ('startup.single_zip', [MAIN, smallest])):
+        seconds, _ = best_time(
+            lambda: subprocess.check_call([sys.executable] + args,
+                                          cwd=TIMELINE_DIR, stdout=devnull),
+            repeat)
+        results[name] = measure(seconds)
+    devnull.close()
+    return results
+
+
+def run_benchmarks(zips, repeat, only=None):
+    results = {}
+
+    def wanted(name):
+        return only is None or any(part in name for part in only)
+
+    if wanted('startup'):
+        results.update(bench_startup(zips, repeat))
+    if wanted('parser'):
+        results.update(bench_parsers(zips, repeat))
+    parsed, timelines = bench_parse_zip_file(zips, repeat)
+    if wanted('parse_zip_file'):
+        results.update(parsed)
+    if wanted('timestamps'):
+        results.update(bench_timestamps(timelines, repeat))
+    combined_results, combined = bench_combine(timelines, repeat)
+    results.update((name, result) for name, result
+                   in combined_results.iteritems() if wanted(name))
+    if wanted('query'):
+        results.update(bench_query(combined, repeat))
+    results.update((name, result) for name, result
+                   in bench_outputs(combined, repeat).iteritems()
+                   if wanted(name))
+    return results
+
+
+def rate(result):
+    """The measure of throughput of a result, higher is better"""
+    for name in RATES:
+        if result.get(name):
+            return name, result[name]
+    return 'per_s', 1.0 / result['seconds']
+
+
+def compare(results, baseline, threshold):
+    """Print how results changed from baseline, returning the names of those
+    that were slower by more than threshold.
+    """
+    regressions = []
+    print('{:<32} {:>14} {:>14} {:>8}'.format('benchmark', 'baseline',
+                                              'current', 'change'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        unit, current = rate(results[name])
+        _, previous = rate(baseline[name])
+        change = current / previous - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = ' !'
+        print('{:<32} {:>14.1f} {:>14.1f} {:>+7.1%}{} {}'.format(
+            name, previous, current, change, flag, unit))
+    return regressions
+
+
+def report(results):
+    print('{:<32} {:>10} {:>10} {:>12} {:>12}'.format(
+        'benchmark', 'seconds', 'MB/s', 'lines/s', 'events/s'))
+    for name, result in sorted(results.iteritems()):
+        print('{:<32} {:>10.3f} {:>10} {:>12} {:>12}'.format(
+            name, result['seconds'],
+            *['{:.1f}'.format(result[rate_name])
+              if result.get(rate_name) else '-' for rate_name in RATES]))
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=BENCHMARK_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark parsing and output of cbcollects')
+    parser.add_argument('--nodes', type=int, default=3,
+                        help='Number of nodes to generate collects for')
+    parser.add_argument('--lines', type=int, default=gencollect.DEFAULT_LINES,
+                        help='Number of lines in each log')
+    parser.add_argument('--density', type=float,
+                        default=gencollect.DEFAULT_DENSITY,
+                        help='Proportion of lines matched by a search')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs to take the best of')
+    parser.add_argument('--collect-dir', default=None,
+                        help='Keep the generated collects in this directory '
+                        'and reuse any already there')
+    parser.add_argument('--only', action='append', default=None,
+                        help='Only run benchmarks whose name contains this')
+    parser.add_argument('--output', default=None,
+                        help='Write the results to this JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='Compare against results saved with --output')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown against the baseline reported as a '
+                        'regression')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    params = {'nodes': args.nodes, 'lines': args.lines,
+              'density': args.density, 'seed': args.seed,
+              'repeat': args.repeat}
+
+    collect_dir = args.collect_dir or tempfile.mkdtemp(prefix='timeline-')
+    try:
+        zips = sorted(os.path.join(collect_dir, name)
+                      for name in os.listdir(collect_dir)
+                      if name.endswith('.zip')) if args.collect_dir and \
+            os.path.isdir(collect_dir) else []
+        if not zips:
+            zips = gencollect.generate_cluster(collect_dir, args.nodes,
+                                               args.lines, args.density,
+                                               args.seed)
+        results = run_benchmarks(zips, args.repeat, args.only)
+    finally:
+        if not args.collect_dir:
+            shutil.rmtree(collect_dir)
+
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'git_rev': git_rev(),
+                       'python': platform.python_implementation() + ' ' +
+                       platform.python_version(),
+                       'date': datetime.datetime.utcnow().isoformat(),
+                       'params': params,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print('Baseline was run with {}'.format(baseline.get('params')),
+                  file=sys.stderr)
+        print()
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('{} regressed by more than {:.0%}'.format(
+                ', '.join(regressions), args.threshold), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
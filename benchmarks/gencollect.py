@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import random
+import zipfile
+
+"""
+Generate synthetic cbcollects for benchmarking.
+
+Each collect has every log that the parsers in LOG_MODULES read. The lines
+are filler apart from a proportion, the hit density, which are built to
+match the searches of the parser for that log. Timestamps increase through
+each log with a fixed UTC offset per node, as in a real collect.
+"""
+
+# Default number of lines in each log, couchbase.log excepted
+DEFAULT_LINES = 100000
+
+# Default proportion of lines that are matched by a search
+DEFAULT_DENSITY = 0.01
+
+START_TIME = datetime.datetime(2016, 1, 1)
+
+LINE_FORMAT = '[{logger}:{level},{timestamp},{node}:<0.{pid}.0>:{where}] {msg}'
+
+FILLER = [
+    'Sending {n} bytes to the connection pool',
+    'Starting compaction for "default/{n}"',
+    'Got stats for bucket "default": {{[{{curr_items,{n}}}]}}',
+    'config change: {{node,\'ns_1@10.0.0.{n}\',membership}} -> active',
+    'vbucket {n} state changed to replica',
+]
+
+# Messages matched by the searches of the parser for each log, those spanning
+# several lines are captured by the parsers with multi_line or until
+HITS = {
+    'diag.log': [
+        'Started rebalancing bucket default',
+        'Rebalance exited with reason {{shutdown,stop}}',
+        "Started node add transaction by adding node 'ns_1@10.0.0.{n}' to "
+        'nodes_wanted',
+        "Node 'ns_1@10.0.0.{n}' was automatically failovered.",
+        "Starting failing over 'ns_1@10.0.0.{n}'",
+        "info:message({node}) - Failed over 'ns_1@10.0.0.{n}': ok",
+        'Port server memcached on node \'babysitter_of_ns_1@127.0.0.1\' '
+        'exited with status 134. Restarting. Messages: foo',
+        'Usage of disk "/data" on node "10.0.0.{n}" is around 91%.',
+        "Node '{node}' saw that node 'ns_1@10.0.0.{n}' went down.",
+        'Data has been lost for 5% of vbuckets in bucket "default".',
+        'Write Commit Failure. Disk write failed for item in Bucket '
+        '"default" on node 10.0.0.{n}.',
+        "Haven't heard from a higher priority node or a master, so I'm "
+        'taking over.',
+        "Current master is older and I'll try to takeover",
+        'Bucket "default" loaded on node \'ns_1@10.0.0.{n}\' in 2 seconds.',
+    ],
+    'ns_server.debug.log': [
+        'Detected time forward jump (or too large erlang scheduling '
+        'latency).  Skipping {n} samples (or {n}0 milliseconds)',
+    ],
+    'ns_server.info.log': [
+        'janitor_agent-default<0.{n}.0>: Doing local bucket flush',
+        'janitor_agent-default<0.{n}.0>: Local flush is done',
+    ],
+    'ns_server.error.log': [
+        "The following buckets became not ready on node '{node}': "
+        '["default"], those of them are active []',
+        "The following buckets became not ready on node '{node}': "
+        '["default",\n  "beer-sample",\n  "travel"], those of them are '
+        'active []',
+    ],
+    'ns_server.babysitter.log': [
+        'Cushion managed supervisor for memcached failed:  {{abnormal,134}}'
+        '\nmemcached<0.{n}.0>: Stack trace follows\nmemcached<0.{n}.0>: '
+        'at 0x{n}\nmemcached<0.{n}.0>: at 0x{n}0\nmemcached<0.{n}.0>: '
+        'assertion failed [vb != {n}] at ep.cc:{n}',
+    ],
+    'ns_server.couchdb.log': [
+        'Too many file descriptors open, closing {n}',
+    ],
+}
+
+
+def timestamps(start, offset_minutes, rand):
+    """Yield increasing timestamps in the form found in the logs"""
+    offset = datetime.timedelta(minutes=offset_minutes)
+    sign = '+' if offset_minutes >= 0 else '-'
+    suffix = '{}{:02d}:{:02d}'.format(sign, abs(offset_minutes) // 60,
+                                      abs(offset_minutes) % 60)
+    now = start + offset
+    while True:
+        now += datetime.timedelta(microseconds=rand.randint(0, 20000))
+        yield '{}.{:03d}{}'.format(now.strftime('%Y-%m-%dT%H:%M:%S'),
+                                   now.microsecond // 1000, suffix)
+
+
+def generate_log(logname, node, lines, density, rand, offset_minutes=60):
+    """Return the contents of a synthetic log of about lines lines"""
+    hits = HITS[logname]
+    times = timestamps(START_TIME, offset_minutes, rand)
+    output = []
+    for i in xrange(lines):
+        if rand.random() < density:
+            msg = rand.choice(hits)
+            level = 'error' if 'error' in logname else 'info'
+        else:
+            msg = rand.choice(FILLER)
+            level = 'debug'
+        output.append(LINE_FORMAT.format(
+            logger='ns_server', level=level, timestamp=next(times),
+            node='ns_1@' + node, pid=rand.randint(1, 9999),
+            where='module:function:{}'.format(i),
+            msg=msg.format(n=rand.randint(1, 99), node='ns_1@' + node)))
+    output.append('')
+    return '\n'.join(output)
+
+
+def generate_couchbase_log(lines, uuid):
+    """couchbase.log holds the cluster uuid part of the way in"""
+    filler = ['{} output of a command run by cbcollect'.format(i)
+              for i in xrange(lines)]
+    term = ('[{{otp,\n  [{{cookie,abc}}]}},\n {{uuid,\n     <<"{}">>]}},'
+            .format(uuid))
+    filler.insert(len(filler) // 2, term)
+    filler.append('')
+    return '\n'.join(filler)
+
+
+def generate_collect(path, node, lines=DEFAULT_LINES, density=DEFAULT_DENSITY,
+                     seed=0, uuid='0123456789abcdef0123456789abcdef'):
+    """Write a synthetic cbcollect for node to path"""
+    rand = random.Random('{}:{}'.format(seed, node))
+    prefix = 'cbcollect_info_ns_1@{}_20160101-000000/'.format(node)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as ci:
+        for logname in sorted(HITS):
+            ci.writestr(prefix + logname,
+                        generate_log(logname, node, lines, density, rand))
+        ci.writestr(prefix + 'couchbase.log',
+                    generate_couchbase_log(lines, uuid))
+
+
+def generate_cluster(directory, nodes=3, lines=DEFAULT_LINES,
+                     density=DEFAULT_DENSITY, seed=0):
+    """Write a collect for each of nodes nodes to directory, returning their
+    paths.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i in range(nodes):
+        node = '10.0.{}.{}'.format(i // 250, i % 250 + 1)
+        path = os.path.join(directory, 'collectinfo-{}.zip'.format(node))
+        generate_collect(path, node, lines, density, seed)
+        paths.append(path)
+    return paths
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic cbcollects')
+    parser.add_argument('directory', help='Directory to write the zips to')
+    parser.add_argument('--nodes', type=int, default=3,
+                        help='Number of nodes to generate collects for')
+    parser.add_argument('--lines', type=int, default=DEFAULT_LINES,
+                        help='Number of lines in each log')
+    parser.add_argument('--density', type=float, default=DEFAULT_DENSITY,
+                        help='Proportion of lines matched by a search')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    for path in generate_cluster(args.directory, args.nodes, args.lines,
+                                 args.density, args.seed):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
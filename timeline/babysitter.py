@@ -5,9 +5,9 @@ from utils import Event
 
 
 class BabysitterParser(BasicLogSearcher):
-    def __init__(self, log_file, timeline):
+    def __init__(self, log_file, timeline, stats=None):
         """ Super into the parent class passing our file and ourselves. """
-        super(BabysitterParser, self).__init__(log_file, timeline)
+        super(BabysitterParser, self).__init__(log_file, timeline, stats)
 
     @BasicLogSearcher.register_search(
         'Cushion managed supervisor for memcached failed:', multi_line=4)
@@ -1,4 +1,192 @@
+import collections
+import itertools
 import re
+import time
+
+from stats import search_stats
+
+# Registration order of searches, used to keep first-match-wins deterministic
+_search_order = itertools.count()
+
+# Most lines an until search captures after its hit, so that a capture that
+# is never ended cannot take up the rest of the log
+MAX_CAPTURE_LINES = 1000
+
+
+class MultiSearch(object):
+    """Matches every registered search of a parser class against a line in a
+    single pass.
+
+    All search strings are compiled into one alternation regex. Most lines
+    match nothing, so they are rejected by one regex search. When a line does
+    hit, the searches are checked individually in the order they were
+    registered so that the earliest registered search still wins, as it did
+    when searches were tried one by one.
+    """
+
+    def __init__(self, searches):
+        self.searches = searches
+        self.regex = None
+        self.buffer_regex = None
+        if searches:
+            # Literal alternatives are left bare, as wrapping them in groups
+            # stops re from skipping ahead to their first characters
+            pattern = '|'.join(
+                '(?:{})'.format(search.string.pattern) if search.regex
+                else re.escape(search.string)
+                for search in searches)
+            self.regex = re.compile(pattern)
+            # For searching a buffer of many lines, so that ^ and $ still
+            # match at the start and end of each line
+            self.buffer_regex = re.compile(pattern, re.MULTILINE)
+
+    def match(self, line):
+        """Return the search that matches line, or None"""
+        if self.regex is None or not self.regex.search(line):
+            return None
+        for search in self.searches:
+            if search.regex:
+                if search.string.search(line):
+                    return search
+            elif search.string in line:
+                return search
+
+
+class ChunkedReader(object):
+    """Reads a log file in large chunks and only cuts whole lines out of the
+    buffer around hits, instead of creating a string for every line.
+    """
+
+    def __init__(self, log_file, chunk_size, stats=None):
+        self.log_file = log_file
+        self.chunk_size = chunk_size
+        self.stats = stats
+        self.buffer = ''
+        # Start of the data not yet scanned, always at the start of a line
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Drop the scanned data and read another chunk onto the end of what
+        is left. Returns False at the end of the file.
+        """
+        if self.eof:
+            return False
+        chunk = self.log_file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.stats is not None:
+            self.stats['bytes'] += len(chunk)
+            self.stats['lines'] += chunk.count('\n')
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def find(self, regex):
+        """Return the next line with a hit for regex, or None at the end of
+        the file. Lines spanning the end of a chunk are completed first.
+        """
+        while True:
+            m = regex.search(self.buffer, self.pos)
+            if m is None:
+                # Keep any partial last line as a hit may span the chunks
+                self.pos = max(self.pos, self.buffer.rfind('\n', self.pos) + 1)
+                if not self.fill():
+                    self.pos = len(self.buffer)
+                    return None
+                continue
+
+            start = max(self.pos,
+                        self.buffer.rfind('\n', self.pos, m.start()) + 1)
+            end = self.buffer.find('\n', m.start())
+            if end == -1:
+                self.pos = start
+                if self.fill():
+                    continue
+                end = len(self.buffer)
+            else:
+                end += 1
+            self.pos = end
+            return self.buffer[start:end]
+
+    def lookahead(self, limit):
+        """Yield up to limit lines after the last hit without consuming
+        them, so the next find still searches them.
+        """
+        # Relative to pos, as filling the buffer moves the data
+        offset = 0
+        for _ in xrange(limit):
+            end = self.buffer.find('\n', self.pos + offset)
+            while end == -1:
+                if not self.fill():
+                    if self.pos + offset < len(self.buffer):
+                        yield self.buffer[self.pos + offset:]
+                    return
+                end = self.buffer.find('\n', self.pos + offset)
+            yield self.buffer[self.pos + offset:end + 1]
+            offset = end + 1 - self.pos
+
+
+class LineWindow(object):
+    """Iterates over lines, letting a search look ahead at the lines after
+    the current one without consuming them.
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        # Lines looked ahead at but not yet iterated over
+        self.ahead = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.ahead:
+            return self.ahead.popleft()
+        return next(self.lines)
+
+    def lookahead(self, limit):
+        """Yield up to limit lines after the current one"""
+        for i in xrange(limit):
+            if i == len(self.ahead):
+                try:
+                    self.ahead.append(next(self.lines))
+                except StopIteration:
+                    return
+            yield self.ahead[i]
+
+
+def ends_capture(search, line):
+    """Whether line holds the until string ending a capture of search"""
+    if search.regex:
+        return search.until.search(line) is not None
+    return search.until in line
+
+
+def capture(search, line, reader):
+    """Return the result of a hit for search on line.
+
+    multi_line and until searches capture the lines after the hit from the
+    lookahead of reader, leaving them to be searched for hits of their own.
+    Returns None if a multi_line capture is cut short by the end of the log,
+    an until capture ends there or after MAX_CAPTURE_LINES instead.
+    """
+    if search.multi_line:
+        search_result = [line]
+        search_result.extend(reader.lookahead(search.multi_line))
+        if len(search_result) <= search.multi_line:
+            return None
+        return search_result
+    if search.until is not None:
+        search_result = [line]
+        if not ends_capture(search, line):
+            for line in reader.lookahead(MAX_CAPTURE_LINES):
+                search_result.append(line)
+                if ends_capture(search, line):
+                    break
+        return search_result
+    return line
 
 
 class BasicLogSearcher(object):
@@ -6,47 +194,108 @@ class BasicLogSearcher(object):
     Child class must implement search_file and pass itself as reference to init
     """
 
-    def __init__(self, log_file, timeline):
+    # Size of the chunks file-like logs are searched in, see scan_chunks.
+    # Set to 0 to read them line by line instead.
+    chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, log_file, timeline, stats=None):
         self.log_file = log_file
         self.timeline = timeline
+        # Counters for --stats, see stats.member_stats
+        self.stats = stats
         self.perform_searches()
 
+    @classmethod
+    def get_scanner(cls):
+        """Build the MultiSearch for this class once and reuse it"""
+        scanner = cls.__dict__.get('_scanner')
+        if scanner is None:
+            scanner = MultiSearch(sorted(
+                (method for method in cls.__dict__.itervalues()
+                 if hasattr(method, 'string')),
+                key=lambda method: method.order))
+            cls._scanner = scanner
+        return scanner
+
     def perform_searches(self):
-        searches = {}
-        for name, method in self.__class__.__dict__.iteritems():
-            if hasattr(method, "string"):
-                searches[method] = []
-
-        for line in self.log_file:
-            for search in searches:
-                if search.regex:
-                    result = re.search(search.string, line)
-                else:
-                    result = search.string in line
-
-                if result:
-                    if search.multi_line:
-                        search_result = [line]
-                        for _ in xrange(search.multi_line):
-                            search_result.append(next(self.log_file))
-                    elif search.until is not None:
-                        search_result = [line]
-                        while not ((re.search(search.until, line))
-                                   if search.regex else
-                                   (search.until in line)):
-                            line = next(self.log_file)
-                            search_result.append(line)
-                    else:
-                        search_result = line
-
-                    searches[search].append(search_result)
-
-                    # Now that we have a result it's safe to assume that
-                    # this line won't match other searches
-                    break
+        scanner = self.get_scanner()
+        searches = dict((search, []) for search in scanner.searches)
+
+        if self.chunk_size and hasattr(self.log_file, 'read'):
+            results = self.scan_chunks(scanner)
+        else:
+            results = self.scan_lines(scanner)
+
+        if self.stats is not None:
+            self.perform_searches_with_stats(scanner, searches, results)
+            return
+
+        # Once a line has a result it's safe to assume that
+        # it won't match other searches
+        for search, search_result in results:
+            searches[search].append(search_result)
+
+        for search in scanner.searches:
+            search(self, searches[search])
 
-        for search in searches:
+    def perform_searches_with_stats(self, scanner, searches, results):
+        """As perform_searches, timing the scan and each handler"""
+        start = time.time()
+        for search, search_result in results:
+            searches[search].append(search_result)
+        self.stats['scan_seconds'] += time.time() - start
+
+        for search in scanner.searches:
+            events = len(self.timeline.events)
+            start = time.time()
             search(self, searches[search])
+            elapsed = time.time() - start
+            self.stats['handler_seconds'] += elapsed
+            counters = search_stats(self.stats, search.__name__)
+            counters['hits'] += len(searches[search])
+            counters['events'] += len(self.timeline.events) - events
+            counters['seconds'] += elapsed
+
+    def scan_lines(self, scanner):
+        """Yield the search and result for each hit, reading line by line"""
+        lines = iter(self.log_file)
+        if self.stats is not None:
+            lines = self.count_lines(lines)
+        lines = LineWindow(lines)
+        for line in lines:
+            search = scanner.match(line)
+            if search is None:
+                continue
+
+            search_result = capture(search, line, lines)
+            if search_result is not None:
+                yield search, search_result
+
+    def count_lines(self, lines):
+        for line in lines:
+            self.stats['bytes'] += len(line)
+            self.stats['lines'] += 1
+            yield line
+
+    def scan_chunks(self, scanner):
+        """Yield the search and result for each hit, searching the raw log
+        a chunk at a time and only cutting out the lines that hit.
+        """
+        if scanner.buffer_regex is None:
+            return
+        reader = ChunkedReader(self.log_file, self.chunk_size, self.stats)
+        while True:
+            line = reader.find(scanner.buffer_regex)
+            if line is None:
+                return
+            search = scanner.match(line)
+            if search is None:
+                # The hit spanned more than one line
+                continue
+
+            search_result = capture(search, line, reader)
+            if search_result is not None:
+                yield search, search_result
 
     @classmethod
     def register_search(cls, string, regex=False, multi_line=0, until=None):
@@ -61,5 +310,6 @@ class BasicLogSearcher(object):
                 func.until = until
             func.regex = regex
             func.multi_line = multi_line
+            func.order = next(_search_order)
             return func
         return decorator
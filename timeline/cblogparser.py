@@ -1,11 +1,60 @@
 import re
 
-COUCHBASE_LOG_UUID_REGEX = re.compile(r'{uuid,[\n\r\s]+(?:.*[\n\r\s]+)+?'
-                                      '<<"([\w]+)">>\]}')
+# A lazy scan for the first <<"uuid">>]} after whitespace, nested repeats
+# of .* would backtrack through every way of splitting the lines after it
+COUCHBASE_LOG_UUID_REGEX = re.compile(r'{uuid,\s(?:.*?\s)?<<"(\w+)">>\]}',
+                                      re.DOTALL)
+COUCHBASE_LOG_UUID_START = '{uuid,'
+
+# How far past the start of the uuid term the uuid itself is looked for
+UUID_MAX_LENGTH = 65536
+
+CHUNK_SIZE = 1048576
 
 
 class CBLogParser(object):
-    def __init__(self, log_file, timeline):
-        m = COUCHBASE_LOG_UUID_REGEX.search(log_file.read())
-        if m:
-            timeline.cluster_uuid = m.group(1)
+    def __init__(self, log_file, timeline, stats=None):
+        uuid = find_cluster_uuid(log_file, stats)
+        if uuid:
+            timeline.cluster_uuid = uuid
+
+
+def find_cluster_uuid(log_file, stats=None):
+    """Stream log_file a chunk at a time until the cluster uuid is found.
+
+    Only the current chunk and, once the start of the uuid term has been
+    seen, up to UUID_MAX_LENGTH bytes of it are held, so memory use does not
+    grow with the size of couchbase.log. Reading stops as soon as the whole
+    term has been read.
+    """
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        start = buf.find(COUCHBASE_LOG_UUID_START, pos)
+        if start != -1:
+            m = COUCHBASE_LOG_UUID_REGEX.match(buf, start,
+                                               start + UUID_MAX_LENGTH)
+            if m:
+                return m.group(1)
+            if eof or len(buf) - start >= UUID_MAX_LENGTH:
+                # Not the term we want, try the next one
+                pos = start + 1
+                continue
+            # Part of the term may still be to come
+            buf = buf[start:]
+        elif eof:
+            return None
+        else:
+            # Keep enough for the start of a term split between chunks
+            buf = buf[max(pos, len(buf) - len(COUCHBASE_LOG_UUID_START) + 1):]
+        pos = 0
+
+        chunk = log_file.read(CHUNK_SIZE)
+        if chunk:
+            if stats is not None:
+                stats['bytes'] += len(chunk)
+                stats['lines'] += chunk.count('\n')
+            buf += chunk
+        else:
+            eof = True
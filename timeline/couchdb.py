@@ -4,9 +4,9 @@ from utils import Event
 
 
 class CouchDBParser(BasicLogSearcher):
-    def __init__(self, log_file, timeline):
+    def __init__(self, log_file, timeline, stats=None):
         """ Super into the parent class passing our file and ourselves. """
-        super(CouchDBParser, self).__init__(log_file, timeline)
+        super(CouchDBParser, self).__init__(log_file, timeline, stats)
 
     @BasicLogSearcher.register_search('Too many file descriptors open')
     def _parse_emfile(self, messages):
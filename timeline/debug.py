@@ -7,9 +7,9 @@ pat_ms = re.compile(r'([0-9]+) milliseconds')
 
 
 class DebugParser(BasicLogSearcher):
-    def __init__(self, log_file, timeline):
+    def __init__(self, log_file, timeline, stats=None):
         """ Super into the parent class passing our file and ourselves. """
-        super(DebugParser, self).__init__(log_file, timeline)
+        super(DebugParser, self).__init__(log_file, timeline, stats)
 
     @BasicLogSearcher.register_search('Detected time forward jump')
     def _parse_time_jumps(self, time_jumps):
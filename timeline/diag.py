@@ -5,9 +5,9 @@ from utils import Event, extract_nodename
 
 
 class DiagParser(BasicLogSearcher):
-    def __init__(self, log_file, timeline):
+    def __init__(self, log_file, timeline, stats=None):
         """ Super into the parent class passing our file and ourselves. """
-        super(DiagParser, self).__init__(log_file, timeline)
+        super(DiagParser, self).__init__(log_file, timeline, stats)
 
     @BasicLogSearcher.register_search('Started rebalancing bucket',)
     def _parse_rebalance_start(self, messages):
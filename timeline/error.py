@@ -5,9 +5,9 @@ from utils import Event, extract_nodename
 
 
 class ErrorParser(BasicLogSearcher):
-    def __init__(self, log_file, timeline):
+    def __init__(self, log_file, timeline, stats=None):
         """ Super into the parent class passing our file and ourselves. """
-        super(ErrorParser, self).__init__(log_file, timeline)
+        super(ErrorParser, self).__init__(log_file, timeline, stats)
 
     @BasicLogSearcher.register_search(
         r"The following buckets became not ready on node",
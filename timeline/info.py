@@ -5,9 +5,9 @@ from utils import Event
 
 
 class InfoParser(BasicLogSearcher):
-    def __init__(self, log_file, timeline):
+    def __init__(self, log_file, timeline, stats=None):
         """ Super into the parent class passing our file and ourselves. """
-        super(InfoParser, self).__init__(log_file, timeline)
+        super(InfoParser, self).__init__(log_file, timeline, stats)
 
     @BasicLogSearcher.register_search('Doing local bucket flush')
     def _parse_flush_start(self, flushes):
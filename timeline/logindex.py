@@ -0,0 +1,196 @@
+from __future__ import print_function
+
+import io
+import json
+import os
+import sys
+
+from utils import pat_time, parse_epoch
+
+"""
+Sidecar indexes of timestamp to byte offset for the logs in a cbcollect.
+
+While a log is read from start to end the timestamp of a line is sampled
+roughly every SAMPLE_INTERVAL bytes. When the same collect is parsed again
+for a --since/--until window the samples let the parsers start reading near
+the beginning of the window and stop shortly after the end of it.
+
+The index of a collect is stored as JSON next to it, or in a cache directory,
+and the samples for a log are only used while the size, CRC and date of its
+ZipInfo still match.
+"""
+
+INDEX_VERSION = 1
+
+# Bytes between index samples
+SAMPLE_INTERVAL = 64 * 1024
+
+# How far into a line to look for its timestamp
+SAMPLE_LINE_LENGTH = 128
+
+# Size of the reads used to skip to the start of a window
+SKIP_SIZE = 1048576
+
+
+def is_indexed(logname):
+    """Whether a log is in time order and so worth indexing"""
+    return logname == 'diag.log' or logname.startswith('ns_server.')
+
+
+def index_path(zip_file, index_dir=None):
+    """Return where the index of zip_file is stored, next to it unless an
+    index_dir is given.
+    """
+    if index_dir is None:
+        return '{}.index'.format(zip_file)
+    return os.path.join(index_dir,
+                        '{}.index'.format(os.path.basename(zip_file)))
+
+
+def member_key(member):
+    """What an index of member is valid for"""
+    return [member.file_size, member.CRC, list(member.date_time)]
+
+
+class LogIndex(object):
+    """The index of every log in a cbcollect"""
+
+    def __init__(self, path):
+        self.path = path
+        self.members = {}
+        self.changed = False
+        try:
+            with open(path, 'r') as f:
+                doc = json.load(f)
+        except (IOError, ValueError):
+            return
+        if doc.get('version') == INDEX_VERSION:
+            self.members = doc['members']
+
+    def get(self, member):
+        """Return the samples for member, or None if there are none that are
+        still valid.
+        """
+        entry = self.members.get(member.filename)
+        if entry is not None and entry['key'] == member_key(member):
+            return entry['samples']
+
+    def put(self, member, samples):
+        self.members[member.filename] = {'key': member_key(member),
+                                         'samples': samples}
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return True
+        temp_path = '{}.tmp'.format(self.path)
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'members': self.members},
+                          f)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            print('Could not write index {}: {}'.format(self.path, e),
+                  file=sys.stderr)
+            return False
+        self.changed = False
+        return True
+
+
+def window_offsets(samples, since=None, until=None):
+    """Return the byte offsets to start and stop reading a log at to cover
+    the window from since to until, given as epoch microseconds.
+
+    Lines are not strictly in time order, so reading starts a sample before
+    the first one inside the window and stops a sample after the first one
+    past the last sample inside it. A stop of None means read to the end.
+    """
+    if not samples:
+        return 0, None
+
+    start_index = 0
+    if since is not None:
+        for index, (epoch, _) in enumerate(samples):
+            if epoch >= since:
+                start_index = max(index - 1, 0)
+                break
+        else:
+            start_index = len(samples) - 1
+
+    stop = None
+    if until is not None:
+        last_index = start_index
+        for index in xrange(start_index, len(samples)):
+            if samples[index][0] <= until:
+                last_index = index
+        if last_index + 2 < len(samples):
+            stop = samples[last_index + 2][1]
+
+    return samples[start_index][1], stop
+
+
+class IndexedLog(io.RawIOBase):
+    """Reads a zip member for the parsers, either recording index samples
+    while reading all of it, or only reading it between start and stop.
+
+    Zip members cannot seek, so the data before start is still decompressed,
+    but it is not scanned.
+    """
+
+    def __init__(self, raw, start=0, stop=None, record=False):
+        self.raw = raw
+        self.offset = 0
+        self.stop = stop
+        self.samples = [] if record else None
+        self.next_sample = 0
+        while self.offset < start:
+            data = raw.read(min(SKIP_SIZE, start - self.offset))
+            if not data:
+                break
+            self.offset += len(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = len(b)
+        if self.stop is not None:
+            size = min(size, self.stop - self.offset)
+            if size <= 0:
+                return 0
+        data = self.raw.read(size)
+        b[:len(data)] = data
+        if self.samples is not None:
+            self.sample(data)
+        self.offset += len(data)
+        return len(data)
+
+    def sample(self, data):
+        """Record the timestamp of the first line starting after each
+        SAMPLE_INTERVAL in data
+        """
+        pos = self.next_sample - self.offset
+        if pos >= len(data):
+            return
+        if pos <= 0 and self.offset == 0:
+            newline = -1
+        else:
+            newline = data.find('\n', max(pos - 1, 0))
+            if newline == -1:
+                return
+        while newline + 1 < len(data):
+            start = newline + 1
+            m = pat_time.search(data, start, start + SAMPLE_LINE_LENGTH)
+            if m:
+                self.samples.append([parse_epoch(m.group(1))[0],
+                                     self.offset + start])
+                pos = start + SAMPLE_INTERVAL
+                self.next_sample = self.offset + pos
+                if pos >= len(data):
+                    return
+                newline = data.find('\n', pos - 1)
+            else:
+                # Try the next line
+                newline = data.find('\n', start)
+            if newline == -1:
+                return
@@ -1,101 +1,315 @@
 from __future__ import print_function
 
 import argparse
+import base64
 import datetime
+import functools
 from glob import iglob
+import heapq
 import io
+from itertools import izip
 import json
 import multiprocessing
 import os
 import re
 import subprocess
 import sys
+import time
 import zipfile
+import zlib
 
 
-import babysitter
-import cblogparser
-import couchdb
-import debug
-import diag
-import error
-import info
-import manager
-from utils import extract_nodename, Event
+from logindex import (index_path, is_indexed, IndexedLog, LogIndex,
+                      window_offsets)
+from parsecache import ParseCache
+from stats import (format_cache_stats, format_stats, get_member_stats,
+                   member_stats, zip_stats)
+from timelineindex import TimelineIndex
+from utils import (BurstEvent, event_from_dict, extract_nodename,
+                   EncodedJSON, Event, parse_epoch)
+import writers
+from writers import html_chunks, node_width, write_timeline
 
 MAX_BUFFER_SIZE = 1048576
 MAX_RESULT_SIZE = 500000
-LOG_MODULES = {'couchbase.log': cblogparser.CBLogParser,
-               'ns_server.couchdb.log': couchdb.CouchDBParser,
-               'diag.log': diag.DiagParser,
-               'ns_server.babysitter.log': babysitter.BabysitterParser,
-               'ns_server.error.log': error.ErrorParser,
-               'ns_server.info.log': info.InfoParser,
-               'ns_server.debug.log': debug.DebugParser}
+# Version of the encoding written by Timeline.to_compact, documents without
+# a format are those written by Timeline.to_json
+COMPACT_FORMAT = 2
+# Default window in seconds within which repeats of an event are merged into
+# one, 0 to keep every event
+BURST_WINDOW = float(os.environ.get('TIMELINE_BURST_WINDOW', 0))
+# The (module, class) of the parser for each log, a parser is only imported
+# once a cbcollect holding its log is parsed
+LOG_MODULES = {'couchbase.log': ('cblogparser', 'CBLogParser'),
+               'ns_server.couchdb.log': ('couchdb', 'CouchDBParser'),
+               'diag.log': ('diag', 'DiagParser'),
+               'ns_server.babysitter.log': ('babysitter',
+                                            'BabysitterParser'),
+               'ns_server.error.log': ('error', 'ErrorParser'),
+               'ns_server.info.log': ('info', 'InfoParser'),
+               'ns_server.debug.log': ('debug', 'DebugParser')}
 
 
 class Timeline(object):
-    def __init__(self, timelines=None, input_dict=None):
+    def __init__(self, timelines=None, input_dict=None, burst_window=0):
         self.events = []
         self.default_node_name = None
+        # Whether events are sorted and free of duplicates
+        self.is_sorted = True
+        # Built by the first query
+        self.event_index = None
+        # Events added with the same node, type and description as one up to
+        # burst_window microseconds before are merged into a BurstEvent
+        self.burst_window = burst_window
+        # Position in events of the latest of each (node, type, description)
+        self.bursts = {}
         if timelines:
-            self.events.extend(event for timeline in timelines
-                               for event in timeline.events)
+            for timeline in timelines:
+                timeline.sort()
+            self.events = list(merge_events(
+                [timeline.events for timeline in timelines]))
         elif input_dict:
-            self.events = [Event(input_dict=event_dict)
+            self.events = [event_from_dict(event_dict)
                            for event_dict in input_dict['events']]
+            self.is_sorted = False
+
+    def copy_details(self, other):
+        """Copy what is known about the node, e.g. cluster_uuid, from another
+        Timeline for the same node.
+        """
+        for name, value in vars(other).iteritems():
+            if name not in ('events', 'is_sorted', 'event_index',
+                            'bursts') and value is not None:
+                setattr(self, name, value)
+
+    def clip(self, since=None, until=None):
+        """Drop events from before since or after until, both given as
+        microseconds since the epoch.
+        """
+        if since is not None or until is not None:
+            self.events = [event for event in self.events
+                           if (since is None or event.epoch >= since) and
+                           (until is None or event.epoch <= until)]
+            self.bursts = {}
+
+    def query(self, since=None, until=None, nodes=None, types=None):
+        """Return a Timeline of the events between since and until, given as
+        microseconds since the epoch, on any of nodes and of any of types.
+        Those left as None are not filtered on.
+
+        Events are looked up in a TimelineIndex, which is built by the first
+        query and again after the events change.
+        """
+        self.sort()
+        if self.event_index is None or \
+                not self.event_index.is_current(self.events):
+            self.event_index = TimelineIndex(self.events)
+        timeline = Timeline()
+        timeline.copy_details(self)
+        timeline.events = self.event_index.query(
+            since, until, set(nodes) if nodes is not None else None,
+            set(types) if types is not None else None)
+        return timeline
 
     def add_event(self, event):
-        self.events.append(event)
+        if not self.burst_window or not self.merge_burst(event):
+            self.events.append(event)
+        self.is_sorted = False
 
     def add_events(self, events):
-        self.events.extend(events)
+        if self.burst_window:
+            for event in events:
+                self.add_event(event)
+        else:
+            self.events.extend(events)
+            self.is_sorted = False
+
+    def merge_burst(self, event):
+        """Merge event into the latest event with the same node, type and
+        description if it is within burst_window of it, returning whether
+        it was merged.
+        """
+        key = (event.node_name, event.type, event.description)
+        position = self.bursts.get(key)
+        if position is not None:
+            burst = self.events[position]
+            last_epoch = (burst.last_epoch if isinstance(burst, BurstEvent)
+                          else burst.epoch)
+            if burst.epoch - self.burst_window <= event.epoch <= \
+                    last_epoch + self.burst_window:
+                if not isinstance(burst, BurstEvent):
+                    burst = BurstEvent.from_event(burst)
+                    self.events[position] = burst
+                burst.merge(event)
+                return True
+        self.bursts[key] = len(self.events)
+        return False
 
     def sort(self):
-        self.events = list(sorted(set(self.events)))
+        if not self.is_sorted:
+            self.events = list(sorted(set(self.events)))
+            self.is_sorted = True
+            self.bursts = {}
+
+    def kept_events(self):
+        """Return the dicts and JSON encodings of the newest events that fit
+        in MAX_RESULT_SIZE.
+
+        Each event is converted and encoded once, from the newest backwards,
+        keeping a running total of the size of the result. Both lists are
+        returned oldest first.
+        """
+        self.sort()
+        budget = MAX_RESULT_SIZE - len(json.dumps({'events': []}))
+        dicts = []
+        encoded = []
+        for event in reversed(self.events):
+            event_dict = event.to_dict()
+            event_json = json.dumps(event_dict)
+            # Add 2 for the separator between events
+            budget -= len(event_json) + (2 if encoded else 0)
+            if budget < 0:
+                break
+            dicts.append(event_dict)
+            encoded.append(event_json)
+        dicts.reverse()
+        encoded.reverse()
+        return dicts, encoded
+
+    def encode_events(self):
+        """JSON encode the newest events that fit in MAX_RESULT_SIZE, oldest
+        first.
+        """
+        return self.kept_events()[1]
 
     def to_dict(self):
+        return {'events': self.kept_events()[0]}
+
+    def to_json(self, **extra):
+        """Return the same result as to_dict already encoded as JSON, with
+        any keyword arguments added as extra fields.
+        """
+        fields = ['{}: {}'.format(json.dumps(key), json.dumps(value))
+                  for key, value in sorted(extra.iteritems())]
+        fields.append('"events": [{}]'.format(', '.join(self.encode_events())))
+        return EncodedJSON('{{{}}}'.format(', '.join(fields)))
+
+    def to_compact(self, **extra):
+        """Return the newest events that fit in MAX_RESULT_SIZE in a compact
+        encoding, as a JSON document with any keyword arguments added as
+        extra fields.
+
+        Epochs are delta coded, each node name, type and description is
+        stored once in a table and referred to by its index, and the columns
+        are zlib compressed and base64 encoded into the data field. The rows
+        that are BurstEvents are listed, if any, with the rest of each burst.
+
+        Base64 costs a third more bytes than storing the compressed data as
+        a binary value, but keeps the document JSON. It is fetched through
+        the same transcoder as those written by to_json, carries git_rev and
+        stats alongside the events, and decode_timeline tells the two apart
+        by its format field.
+        """
         self.sort()
-        result = {'events': [event.to_dict() for event in self.events]}
-
-        # Rough guess at the size of the result
-        size_of_result = len(json.dumps(result))
-
-        size_deficit = size_of_result - MAX_RESULT_SIZE
-
-        while size_deficit > 0:
-            # Calculate amount removed (with 1 added for the comma)
-            size_of_event = len(json.dumps(result['events'][0])) + 1
-            del result['events'][0]
-            size_deficit -= size_of_event
-
-        return result
-
-    def to_html(self):
-        import ansiconv
-        output = """
-            <style>
-              {}
+        events = self.events
+        document = compact_document(events, extra)
+        while len(document) > MAX_RESULT_SIZE and events:
+            # Keep the newest events in proportion to the budget, with a
+            # margin as the compression ratio varies
+            kept = int(len(events) * 0.9 * MAX_RESULT_SIZE / len(document))
+            events = events[len(events) - min(kept, len(events) - 1):]
+            document = compact_document(events, extra)
+        return document
+
+    @classmethod
+    def from_compact(cls, document):
+        """Decode a document written by to_compact"""
+        if document.get('format') != COMPACT_FORMAT:
+            raise ValueError('Unsupported timeline format {}'
+                             .format(document.get('format')))
+        payload = json.loads(zlib.decompress(base64.b64decode(
+            document['data'])))
+        nodes, types, descriptions = payload['tables']
+        timeline = cls()
+        epoch = 0
+        for delta, offset, node_id, type_id, description_id in izip(
+                *payload['columns']):
+            epoch += delta
+            timeline.events.append(Event.from_fields(
+                epoch, offset, nodes[node_id], types[type_id],
+                descriptions[description_id]))
+        for row, count, span, last_offset in payload.get('bursts', ()):
+            burst = BurstEvent.from_event(timeline.events[row])
+            burst.count = count
+            burst.last_epoch = burst.epoch + span
+            burst.last_offset = last_offset
+            timeline.events[row] = burst
+        return timeline
 
-              div.timelinetool {{
-                font-family: monospace;
-                white-space: pre-wrap;
-                padding: 10px;
-              }}
-            </style>
-            <div class="timelinetool ansi_fore ansi_back">{}</div>
-            """.format(ansiconv.base_css(), ansiconv.to_html(str(self)))
-        return output
+    def to_html(self, page_size=writers.PAGE_SIZE, page=1):
+        return ''.join(html_chunks(self, page_size, page))
 
     def __str__(self):
         self.sort()
-        node_width = max(len(event.node_name) + 4 for event in self.events)
-        for event in self.events:
-            event.node_width = node_width
-        return '\n'.join([str(event) for event in self.events])
-
-
-def create_timeline(parsed_args):
+        width = node_width(self.events)
+        return '\n'.join([event.format(width) for event in self.events])
+
+
+def compact_document(events, extra):
+    """Encode sorted events as described by Timeline.to_compact"""
+    tables = ({}, {}, {})
+    columns = ([], [], [], [], [])
+    epochs, offsets, node_ids, type_ids, description_ids = columns
+    nodes, types, descriptions = tables
+    # The row, count, span and last offset of each BurstEvent
+    bursts = []
+    previous = 0
+    for row, event in enumerate(events):
+        if isinstance(event, BurstEvent):
+            bursts.append([row, event.count,
+                           event.last_epoch - event.epoch,
+                           event.last_offset])
+        epochs.append(event.epoch - previous)
+        previous = event.epoch
+        offsets.append(event.offset)
+        node_ids.append(nodes.setdefault(event.node_name, len(nodes)))
+        type_ids.append(types.setdefault(event.type, len(types)))
+        description_ids.append(descriptions.setdefault(event.description,
+                                                       len(descriptions)))
+    payload = {'tables': [sorted(table, key=table.get) for table in tables],
+               'columns': columns}
+    if bursts:
+        payload['bursts'] = bursts
+    payload = json.dumps(payload, separators=(',', ':'))
+    document = dict(extra, format=COMPACT_FORMAT,
+                    data=base64.b64encode(zlib.compress(payload)))
+    return EncodedJSON(json.dumps(document, sort_keys=True))
+
+
+def merge_events(runs):
+    """Stream-merge sorted runs of events, dropping duplicates.
+
+    Duplicates share a timestamp, so only events with the same timestamp as
+    the previous one need checking.
+    """
+    epoch = None
+    seen = set()
+    for event in heapq.merge(*runs):
+        if event.epoch != epoch:
+            epoch = event.epoch
+            seen.clear()
+        elif event in seen:
+            continue
+        seen.add(event)
+        yield event
+
+
+def create_timeline(parsed_args, cache=None, stats=None):
+    """Parse the cbcollects given on the command line into one Timeline.
+
+    If stats is a dict, the statistics of parsing each zip are added to it
+    keyed by the zip.
+    """
     zips = []
     if not parsed_args.locations:
         for ci_zip in iglob('./*.zip'):
@@ -107,27 +321,128 @@ def create_timeline(parsed_args):
         for location in parsed_args.locations:
             zips.append(location)
 
-    pool = multiprocessing.Pool(
-        min(multiprocessing.cpu_count(), len(zips)))
-    if len(zips) > 1:
-        results = pool.map_async(multiprocessing_parse_zip_file,
-                                 zips).get(9999)
-        final_timeline = Timeline(results)
+    # Work is scheduled per member across all of the zips so that a single
+    # zip is still parsed in parallel, largest members first so that a big
+    # log does not hold up the pool at the end
+    since = parse_epoch(parsed_args.since)[0] if parsed_args.since else None
+    until = parse_epoch(parsed_args.until)[0] if parsed_args.until else None
+    burst_window = int(parsed_args.burst_window * 1000000)
+    use_index = parsed_args.index or parsed_args.index_dir is not None
+
+    node_timelines = []
+    timelines = {}
+    indexes = {}
+    cache_keys = {}
+    tasks = []
+    for zip_file in zips:
+        if cache is not None:
+            cache_keys[zip_file] = cache.key(zip_file)
+            timeline = load_cached(cache, cache_keys[zip_file], burst_window)
+            if timeline is not None:
+                timeline.clip(since, until)
+                node_timelines.append(timeline)
+                if stats is not None:
+                    stats[zip_file] = zip_stats()
+                    stats[zip_file]['cached'] = True
+                continue
+
+        result = list_zip_members(zip_file)
+        if result is None:
+            continue
+        timelines[zip_file], members = result
+        if stats is not None:
+            stats[zip_file] = zip_stats()
+        if use_index:
+            indexes[zip_file] = LogIndex(index_path(zip_file,
+                                                    parsed_args.index_dir))
+        for member in members:
+            tasks.append({
+                'zip_file': zip_file,
+                'node_name': timelines[zip_file].default_node_name,
+                'member': member,
+                'since': since,
+                'until': until,
+                'burst_window': burst_window,
+                'index': use_index,
+                'samples': (indexes[zip_file].get(member) if use_index
+                            else None),
+                'stats': stats is not None})
+    tasks.sort(key=lambda task: task['member'].file_size, reverse=True)
+
+    partials = dict((zip_file, []) for zip_file in timelines)
+    if len(tasks) > 1:
+        pool = multiprocessing.Pool(min(multiprocessing.cpu_count(),
+                                        len(tasks)))
+        results = pool.imap_unordered(multiprocessing_parse_member, tasks)
     else:
-        final_timeline = parse_zip_file(zips[0])
-
-    return final_timeline
+        pool = None
+        results = (multiprocessing_parse_member(task) for task in tasks)
+    for result in results:
+        partials[result['zip_file']].append(result['timeline'])
+        if result['samples'] is not None:
+            indexes[result['zip_file']].put(result['member'],
+                                            result['samples'])
+        if result['stats'] is not None:
+            # Members are parsed in parallel, so this is the time spent
+            # rather than the time taken
+            zip_file_stats = stats[result['zip_file']]
+            zip_file_stats['members'][os.path.split(
+                result['member'].filename)[-1]] = result['stats']
+            zip_file_stats['seconds'] += result['stats']['seconds']
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for index in indexes.itervalues():
+        index.save()
+
+    for zip_file, timeline in timelines.iteritems():
+        node_timeline = Timeline(timelines=partials[zip_file],
+                                 burst_window=burst_window)
+        node_timeline.copy_details(timeline)
+        for partial in partials[zip_file]:
+            node_timeline.copy_details(partial)
+        node_timelines.append(node_timeline)
+        # Only whole timelines are cached
+        if cache is not None and since is None and until is None:
+            cache.put(cache_keys[zip_file], vars(node_timeline))
+
+    if len(node_timelines) == 1:
+        return node_timelines[0]
+    return Timeline(timelines=node_timelines)
+
+
+def decode_timeline(timeline_dict):
+    """Decode a stored node timeline, sorted ready to be combined"""
+    if 'format' in timeline_dict:
+        return Timeline.from_compact(timeline_dict)
+    timeline = Timeline(input_dict=timeline_dict)
+    timeline.sort()
+    return timeline
 
 
-def combine_timelines(timeline_dicts):
-    """Used as an entry point for the CombinerManager"""
-    timelines = [Timeline(input_dict=timeline_dict)
-                 for timeline_dict in timeline_dicts]
+def combine_timelines(timelines):
+    """Used as an entry point for the CombinerManager, timelines are those
+    made by decode_timeline.
+    """
     final_timeline = Timeline(timelines=timelines)
     return final_timeline
 
 
-def parse_zip_file(zip_file):
+def get_parser(logname):
+    """Import and return the parser for a log in LOG_MODULES"""
+    module_name, class_name = LOG_MODULES[logname]
+    # Imported relative to this module, as its own imports are
+    module = __import__(module_name, globals(), {}, [class_name], -1)
+    return getattr(module, class_name)
+
+
+def list_zip_members(zip_file):
+    """Find the node name and collection time of a cbcollect and the members
+    of it that one of the LOG_MODULES can parse.
+
+    Returns a Timeline holding the details of the node along with the
+    ZipInfo of each member, or None if the zip cannot be opened.
+    """
     timeline = Timeline()
     try:
         ci = zipfile.ZipFile(zip_file, 'r')
@@ -135,37 +450,139 @@ def parse_zip_file(zip_file):
         print('Could not open file: {}'.format(zip_file), file=sys.stderr)
         return
 
-    for name in ci.namelist():
+    members = []
+    for info in ci.infolist():
         # determine a default nodename that can be used when parsing
         # cannot otherwise determine the nodename
         if not timeline.default_node_name:
-            nodename = extract_nodename(name, 'unnamed_node')
+            nodename = extract_nodename(info.filename, 'unnamed_node')
 
             # strip cbcollect_info timestamp from nodename
             nodename = re.sub(r'_[0-9]{8}-[0-9]{6}$', '', nodename)
             timeline.default_node_name = nodename
         # determine if the file included in this zip can be parsed
         # by one of the modules. if so, add to tasks.
-        logname = os.path.split(name)[-1]
+        logname = os.path.split(info.filename)[-1]
         if logname == 'couchbase.log':
             timeline.collection_time = datetime.datetime(
-                *ci.getinfo(name).date_time).isoformat()
-        try:
-            LOG_MODULES[logname](io.BufferedReader(
-                ci.open(name), MAX_BUFFER_SIZE), timeline)
-        except KeyError:
-            pass
+                *info.date_time).isoformat()
+        if logname in LOG_MODULES:
+            members.append(info)
     ci.close()
+    return timeline, members
+
+
+def parse_member(ci, member, timeline, since=None, until=None, index=False,
+                 samples=None, stats=None):
+    """Parse a member of an open cbcollect into timeline.
+
+    With index set, logs that can be indexed are only read between since and
+    until using their index samples, or are read in full to record samples
+    if there are none yet. Returns the samples recorded, if any.
+
+    stats, from stats.member_stats, is filled in if given.
+    """
+    logname = os.path.split(member.filename)[-1]
+    log_file = ci.open(member)
+    if index and is_indexed(logname):
+        if samples is None:
+            log_file = IndexedLog(log_file, record=True)
+        else:
+            start, stop = window_offsets(samples, since, until)
+            log_file = IndexedLog(log_file, start, stop)
+    if stats is not None:
+        start = time.time()
+        events = len(timeline.events)
+    get_parser(logname)(io.BufferedReader(log_file, MAX_BUFFER_SIZE),
+                        timeline, stats)
+    if stats is not None:
+        stats['seconds'] += time.time() - start
+        stats['events'] += len(timeline.events) - events
+    if isinstance(log_file, IndexedLog):
+        return log_file.samples
+
+
+def load_cached(cache, key, burst_window=0):
+    """Return the Timeline stored under key in a ParseCache, or None if it
+    is not there or its events were merged with another burst_window.
+    """
+    state = cache.get(key)
+    if state is None or state.get('burst_window', 0) != burst_window:
+        return None
+    timeline = Timeline()
+    timeline.__dict__.update(state)
+    return timeline
+
+
+def parse_zip_file(zip_file, cache=None, stats=None, burst_window=0):
+    """Parse a cbcollect into a Timeline. stats, from stats.zip_stats, is
+    filled in if given.
+
+    Repeats of an event within burst_window microseconds are merged into a
+    BurstEvent.
+    """
+    start = time.time()
+    if cache is not None:
+        cache_key = cache.key(zip_file)
+        timeline = load_cached(cache, cache_key, burst_window)
+        if timeline is not None:
+            if stats is not None:
+                stats['cached'] = True
+                stats['seconds'] += time.time() - start
+            return timeline
+
+    result = list_zip_members(zip_file)
+    if result is None:
+        return
+    timeline, members = result
+    timeline.burst_window = burst_window
+
+    ci = zipfile.ZipFile(zip_file, 'r')
+    for member in members:
+        parse_member(ci, member, timeline, stats=get_member_stats(
+            stats, os.path.split(member.filename)[-1]))
+    ci.close()
+    timeline.sort()
+    if cache is not None:
+        cache.put(cache_key, vars(timeline))
+    if stats is not None:
+        stats['seconds'] += time.time() - start
     return timeline
 
 
-def multiprocessing_parse_zip_file(zip_file):
+def multiprocessing_parse_member(task):
+    """Parse a single member of a cbcollect into a Timeline of its own, the
+    results are merged back per node by create_timeline.
+    """
+    timeline = Timeline(burst_window=task['burst_window'])
+    timeline.default_node_name = task['node_name']
+    stats = member_stats() if task['stats'] else None
+    ci = zipfile.ZipFile(task['zip_file'], 'r')
     try:
-        timeline = parse_zip_file(zip_file)
-    except Exception as e:
-        raise e
-    else:
-        return timeline
+        samples = parse_member(ci, task['member'], timeline, task['since'],
+                               task['until'], task['index'], task['samples'],
+                               stats)
+    finally:
+        ci.close()
+    timeline.clip(task['since'], task['until'])
+    timeline.sort()
+    return {'zip_file': task['zip_file'],
+            'member': task['member'],
+            'timeline': timeline,
+            'samples': samples,
+            'stats': stats}
+
+
+def positive_int(value):
+    """An argparse type for integers of at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'
+                                         .format(value))
+    return number
 
 
 def parse_arguments(timeline_args):
@@ -176,34 +593,111 @@ def parse_arguments(timeline_args):
                         help='Locations of cbcollects')
     parser.add_argument('--output', choices=['text', 'json', 'html'],
                         default='text', help='Output format to use')
+    parser.add_argument('--output-file', default=None,
+                        help='Write the output to this file rather than '
+                        'stdout')
+    parser.add_argument('--page-size', type=positive_int,
+                        default=writers.PAGE_SIZE,
+                        help='Number of events on each page of the html '
+                        'output')
+    parser.add_argument('--page', type=positive_int, default=1,
+                        help='Page of the html output to write, from 1')
     parser.add_argument('--mode', choices=['parse_only', 'combine',
                                            'default', 'convert_json'],
                         default='default', help='Mode to run nutshell in')
+    parser.add_argument('--cache-dir',
+                        default=os.environ.get('TIMELINE_CACHE_DIR'),
+                        help='Cache parsed cbcollects in this directory')
+    parser.add_argument('--since', default=None,
+                        help='Only include events from this time onwards')
+    parser.add_argument('--until', default=None,
+                        help='Only include events up to this time')
+    parser.add_argument('--burst-window', type=float, default=BURST_WINDOW,
+                        help='Merge repeats of an event on a node that are '
+                        'less than this many seconds apart into one, giving '
+                        'their count and last timestamp')
+    parser.add_argument('--node', action='append', dest='nodes',
+                        default=None,
+                        help='Only include events on this node, can be given '
+                        'more than once')
+    parser.add_argument('--type', action='append', dest='types',
+                        default=None,
+                        help='Only include events of this type, e.g. crash or '
+                        'fail, can be given more than once')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print statistics on the parsing of each log to '
+                        'stderr, or store them with the parsed timelines in '
+                        'parse_only mode')
+    parser.add_argument('--index', action='store_true',
+                        help='Keep an index of timestamps to offsets next to '
+                        'each cbcollect so that --since/--until can skip '
+                        'straight to the relevant part of each log')
+    parser.add_argument('--index-dir', default=None,
+                        help='Keep the indexes in this directory instead, '
+                        'implies --index')
     return parser.parse_args(timeline_args)
 
 
-def main():
-    parsed_args = parse_arguments(sys.argv[1:])
+def get_git_rev():
+    """The revision of timeline that is running, as stamped into
+    TIMELINE_GIT_REV when installed or else found from git.
+    """
+    git_rev = os.environ.get('TIMELINE_GIT_REV')
+    if git_rev:
+        return git_rev
     script_dir = os.path.dirname(os.path.realpath(__file__))
-    git_rev = subprocess.check_output('cd ' + script_dir +
-                                      '&& git describe --long 2>/dev/null'
-                                      "|| echo 'g'`git rev-parse --short"
-                                      ' HEAD`', shell=True).strip()
+    return subprocess.check_output('cd ' + script_dir +
+                                   '&& git describe --long 2>/dev/null'
+                                   "|| echo 'g'`git rev-parse --short"
+                                   ' HEAD`', shell=True).strip()
 
+
+def main():
+    parsed_args = parse_arguments(sys.argv[1:])
+    # Only the Managers and the parse cache need the revision, and finding
+    # it from git is a noticeable part of a short run
+    manager_mode = parsed_args.mode in ('parse_only', 'combine')
+    git_rev = None
+    if manager_mode or parsed_args.cache_dir:
+        git_rev = get_git_rev()
+
+    cache = None
+    if parsed_args.cache_dir:
+        cache = ParseCache(parsed_args.cache_dir, git_rev)
+
+    if manager_mode:
+        # The Managers pull in multiprocessing, Couchbase and the metrics
+        # server, none of which a one-off run needs
+        import manager
     if parsed_args.mode == 'parse_only':
-        manager.ParserManager(parsed_args.locations[0], parse_zip_file,
-                              git_rev)
+        burst_window = int(parsed_args.burst_window * 1000000)
+        manager.ParserManager(parsed_args.locations[0],
+                              functools.partial(parse_zip_file, cache=cache,
+                                                burst_window=burst_window),
+                              git_rev, parsed_args.stats, cache)
     elif parsed_args.mode == 'combine':
         manager.CombinerManager(parsed_args.locations[0], combine_timelines,
-                                git_rev)
-
-    timeline = create_timeline(parsed_args)
-    if parsed_args.output == 'json':
-        print(timeline.to_dict())
-    elif parsed_args.output == 'html':
-        print(timeline.to_html())
+                                git_rev, decode_timeline)
+
+    stats = {} if parsed_args.stats else None
+    timeline = create_timeline(parsed_args, cache, stats)
+    if parsed_args.nodes or parsed_args.types:
+        # since and until were already applied while parsing
+        timeline = timeline.query(nodes=parsed_args.nodes,
+                                  types=parsed_args.types)
+    options = {}
+    if parsed_args.output == 'html':
+        options['page_size'] = parsed_args.page_size
+        options['page'] = parsed_args.page
+    if parsed_args.output_file:
+        with open(parsed_args.output_file, 'w') as out:
+            write_timeline(timeline, parsed_args.output, out, **options)
     else:
-        print(timeline)
+        write_timeline(timeline, parsed_args.output, sys.stdout, **options)
+    if stats is not None:
+        print(format_stats(stats), file=sys.stderr)
+        if cache is not None:
+            print(format_cache_stats(cache.counters()), file=sys.stderr)
     return 0
 
 
@@ -1,12 +1,24 @@
+import json
 import logging
 import multiprocessing
 import os
+import Queue
+import resource
+import socket
 import sys
 import signal
+import threading
 import time
 import uuid
 import zipfile
 
+from metrics import Registry
+from stats import zip_stats
+from store import BatchStore
+from timelinecache import TimelineCache
+from utils import EncodedJSON
+from watcher import create_watcher
+
 """
 A Manager is an object that creates and manages a daemonised process.
 
@@ -24,13 +36,96 @@ on any relevant information to other services.
 # Number of parsing worker threads
 POOL_SIZE = os.environ.get('TIMELINE_POOL_SIZE', multiprocessing.cpu_count())
 
-# Time to sleep between directory trawls
+# Longest time to wait for new files between directory trawls
 SLEEP_TIME = 15
 
+# Time to wait before retrying a write to Magic Bob
+RETRY_TIME = 1
+
+# Bound on the results waiting between stages of the ParserManager
+QUEUE_SIZE = 2 * int(POOL_SIZE)
+
+# Encoding of stored timelines, either json or compact
+STORE_FORMAT = os.environ.get('TIMELINE_STORE_FORMAT', 'json')
+
+# Number of zips a parse worker handles before it is replaced, 0 for no limit
+MAX_TASKS_PER_WORKER = int(os.environ.get('TIMELINE_WORKER_MAX_TASKS', 50))
+
+# Limit in bytes on the address space of each parse worker, 0 for no limit
+WORKER_MEMORY_LIMIT = int(os.environ.get('TIMELINE_WORKER_MEMORY_LIMIT', 0))
+
+# RSS in bytes past which a parse worker is killed, 0 for no limit
+WORKER_RSS_LIMIT = int(os.environ.get('TIMELINE_WORKER_RSS_LIMIT', 0))
+
+# Number of times a zip is re-queued after killing its worker
+MAX_CRASHES = 2
+
+# Longest file name a parse worker can report it is working on
+MAX_PATH = 4096
+
+# Time between checks on the pipeline stages and parse workers
+SUPERVISE_TIME = 1
+
+# Port to serve Prometheus metrics on, 0 to not serve them
+METRICS_PORT = int(os.environ.get('TIMELINE_METRICS_PORT', 0))
+
 logging.basicConfig(format='%(levelname)s|%(name)s: %(message)s',
                     level=logging.INFO)
 
 
+def encoded_json_transcoder():
+    """Create a Transcoder which stores EncodedJSON documents as they are,
+    flagged as JSON, rather than encoding them a second time.
+    """
+    from couchbase import FMT_JSON
+    from couchbase.transcoder import Transcoder
+
+    class EncodedJSONTranscoder(Transcoder):
+        def encode_value(self, value, format):
+            if isinstance(value, EncodedJSON):
+                return str(value), FMT_JSON
+            return super(EncodedJSONTranscoder, self).encode_value(value,
+                                                                   format)
+
+    return EncodedJSONTranscoder()
+
+
+def process_rss(pid):
+    """Return the resident set size of a process in bytes, or None if it
+    cannot be found.
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid), 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def reset_logging_locks():
+    """Replace the locks of the logging module and its handlers in a forked
+    child. Another thread of the parent can hold one at the time of the fork,
+    and Python 2 does not reset them, so the child's first log call would
+    wait on it forever.
+    """
+    logging._lock = threading.RLock()
+    loggers = [logging.getLogger()]
+    loggers.extend(logging.Logger.manager.loggerDict.values())
+    for logger in loggers:
+        # Placeholders in the logger tree have no handlers
+        for handler in getattr(logger, 'handlers', ()):
+            handler.createLock()
+
+
+def queue_depth(queue):
+    """qsize is not implemented for multiprocessing queues on every
+    platform, in which case the depth is unknown.
+    """
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return float('nan')
+
+
 class Manager(object):
     def __init__(self, directory, suffix, work_function, git_rev):
         self.logger = logging.getLogger('timeline.manager')
@@ -46,7 +141,8 @@ class Manager(object):
                 conn_str = 'couchbase://{}/{}'.format(
                     os.environ.get('DB_HOST', 'localhost'),
                     os.environ.get('DB_BUCKET_TIMELINE', 'timeline'))
-                self.bucket = Bucket(conn_str)
+                self.bucket = Bucket(conn_str,
+                                     transcoder=encoded_json_transcoder())
                 self.bucket.timeout = 30
                 self.logger.info('Successfully connected to {}'
                                  .format(conn_str))
@@ -55,16 +151,30 @@ class Manager(object):
                                      exc_info=True)
                 sys.exit(1)
             self.directory = directory
+            self.watcher = create_watcher(directory)
             self.suffix = suffix
             self.work_function = work_function
             self.git_rev = git_rev
-
-    def trawl_directory(self):
-        for file_name in os.listdir(self.directory):
-            full_path = os.path.join(self.directory, file_name)
-            if file_name.endswith(self.suffix):
+            self.metrics = Registry()
+            self.upsert_seconds = self.metrics.histogram(
+                'timeline_upsert_seconds',
+                'Time taken to store documents in Couchbase')
+
+    def serve_metrics(self):
+        if not METRICS_PORT:
+            return
+        try:
+            self.metrics.serve(METRICS_PORT)
+        except socket.error:
+            # Metrics are not worth stopping the Manager for
+            self.logger.error('Unable to serve metrics on port {}'
+                              .format(METRICS_PORT), exc_info=True)
+
+    def trawl_directory(self, timeout=SLEEP_TIME):
+        for full_path in self.watcher.wait(timeout):
+            # Files can be gone by the time their event is seen
+            if full_path.endswith(self.suffix) and os.path.isfile(full_path):
                 self.file_action(full_path)
-        time.sleep(SLEEP_TIME)
 
     def file_action(self, file_name):
         raise NotImplementedError
@@ -73,7 +183,7 @@ class Manager(object):
         try:
             os.remove(file_name)
             self.logger.info('Removed {}'.format(file_name))
-        except IOError:
+        except OSError:
             self.logger.error('Failed to remove {}'.format(file_name),
                               exc_info=True)
             return False
@@ -83,8 +193,10 @@ class Manager(object):
     def store_in_cb(self, key, doc):
         from couchbase.exceptions import TimeoutError, TemporaryFailError, \
             ValueFormatError
+        start = time.time()
         try:
             self.bucket.upsert(key, doc)
+            self.upsert_seconds.observe(time.time() - start)
             self.logger.info('Stored {} in CB'.format(key))
         except (TimeoutError, TemporaryFailError):
             self.logger('Experienced timeout storing key `{}` in Couchbase, '
@@ -106,147 +218,425 @@ class Manager(object):
 
 
 class ParserManager(Manager):
-    def __init__(self, directory, parse_func, git_rev):
+    def __init__(self, directory, parse_func, git_rev, stats=False,
+                 cache=None):
         super(ParserManager, self).__init__(directory, '.zip', parse_func,
                                             git_rev)
         self.logger = logging.getLogger('timeline.manager.parser')
-        self.processing_queue = multiprocessing.Queue()
-        self.file_list = []
-        self.processed_queue = multiprocessing.Queue()
+        # The ParseCache used by parse_func, if any. Each worker has its own
+        # copy, so its counters are sent back with every result
+        self.cache = cache
+        # Whether to store parsing statistics with each timeline
+        self.stats = stats
+        # The stages of the pipeline are joined by bounded queues, so each
+        # one waits on real work and pushes back on the one before it
+        self.processing_queue = Queue.Queue(QUEUE_SIZE)
+        self.file_list = set()
+        self.file_list_lock = threading.Lock()
+        self.processed_queue = multiprocessing.Queue(QUEUE_SIZE)
+        # Times each zip has been re-queued after killing its worker
+        self.crashes = {}
         self.register_kill()
-        for i in range(0, int(POOL_SIZE)):
-            p = multiprocessing.Process(target=self.parse_to_json,
-                                        args=())
-            p.start()
+        # A (process, file being parsed, task queue, generation) for each
+        # parse worker, the generation counting the workers started
+        self.workers = [None] * int(POOL_SIZE)
+        self.workers_lock = threading.Lock()
+        self.generation = 0
+        # The (index, generation) of each parse worker waiting for a zip
+        self.idle_workers = multiprocessing.Queue()
+        for i in range(len(self.workers)):
+            self.start_worker(i)
+        self.store = BatchStore(self.bucket, latency=self.upsert_seconds)
+
+        self.stages = []
+        self.register_metrics()
+        # Workers are re-forked after this, each closes the server socket it
+        # inherits
+        self.serve_metrics()
+        for stage in (self.watch_stage, self.dispatch_stage,
+                      self.result_stage, self.announce_stage):
+            thread = threading.Thread(target=stage, name=stage.__name__)
+            thread.daemon = True
+            thread.start()
+            self.stages.append(thread)
+
+        # Sleeping rather than joining leaves the main thread free for signals
         while True:
-            while not self.processed_queue.empty():
-                parse_result = self.processed_queue.get()
-                # If a result is None then there has been an error
-                # Don't bother trying to store this, but delete
-                # the file still
-                if (parse_result is not None and
-                        parse_result['result'] is not None):
-                    if not self.store_parsed_log(
-                            parse_result['result'],
-                            parse_result['uuid'],
-                            parse_result['collected_date'],
-                            parse_result['node_name']):
-                        self.processed_queue.put(parse_result)
-                        self.logger.info('Added {} back to the processed '
-                                         'queue'.format(
-                                             parse_result['file_name']))
+            time.sleep(SUPERVISE_TIME)
+            for thread in self.stages:
+                if not thread.is_alive():
+                    self.logger.critical('Pipeline stage {} has stopped'
+                                         .format(thread.name))
+                    os._exit(1)
+            self.supervise_workers()
+
+    def start_worker(self, index):
+        current = multiprocessing.Array('c', MAX_PATH)
+        tasks = multiprocessing.Queue(1)
+        self.generation += 1
+        worker = multiprocessing.Process(
+            target=self.parse_to_json,
+            args=(index, self.generation, current, tasks))
+        worker.start()
+        self.workers[index] = (worker, current, tasks, self.generation)
+
+    def register_metrics(self):
+        metrics = self.metrics
+        metrics.gauge('timeline_processing_queue_depth',
+                      'Zips waiting for a parse worker',
+                      lambda: queue_depth(self.processing_queue))
+        metrics.gauge('timeline_processed_queue_depth',
+                      'Parsed timelines waiting to be stored',
+                      lambda: queue_depth(self.processed_queue))
+        metrics.gauge('timeline_store_pending',
+                      'Timelines waiting to be batched into Couchbase',
+                      lambda: self.store.pending.qsize())
+        metrics.gauge('timeline_store_retrying',
+                      'Timelines waiting to be retried after failing to store',
+                      lambda: len(self.store.retrying))
+        metrics.counter('timeline_store_retries_total',
+                        'Retries of timelines that failed to store',
+                        lambda: self.store.retry_count)
+        metrics.gauge('timeline_worker_alive', 'Whether each parse worker is '
+                      'alive', lambda: [({'worker': i}, int(worker.is_alive()))
+                                        for i, (worker, _, _, _)
+                                        in enumerate(self.workers)])
+        metrics.gauge('timeline_stage_alive', 'Whether each pipeline stage is '
+                      'alive', lambda: [({'stage': thread.name},
+                                         int(thread.is_alive()))
+                                        for thread in self.stages])
+        self.worker_restarts = metrics.counter(
+            'timeline_worker_restarts_total',
+            'Parse workers replaced after exiting')
+        self.worker_crashes = metrics.counter(
+            'timeline_worker_crashes_total',
+            'Parse workers that died part way through a zip')
+        self.zips_parsed = metrics.counter(
+            'timeline_zips_parsed_total', 'Zips parsed into a timeline')
+        self.zips_failed = metrics.counter(
+            'timeline_zips_failed_total', 'Zips that could not be parsed')
+        self.zip_bytes = metrics.counter(
+            'timeline_zip_bytes_total', 'Bytes of the zips parsed')
+        self.parse_seconds = metrics.histogram(
+            'timeline_parse_seconds', 'Time taken to parse a zip')
+        self.encode_seconds = metrics.histogram(
+            'timeline_encode_seconds',
+            'Time taken to encode a parsed timeline for storage')
+        self.magicbob_seconds = metrics.histogram(
+            'timeline_magicbob_write_seconds',
+            'Time taken to write a key to Magic Bob')
+        self.parse_cache_counters = dict(
+            (name, metrics.counter('timeline_parse_cache_{}_total'
+                                   .format(name), description))
+            for name, description in (
+                ('hits', 'Zips found in the parse cache'),
+                ('misses', 'Zips not found in the parse cache'),
+                ('evictions', 'Entries evicted from the parse cache')))
+
+    def supervise_workers(self):
+        """Replace any parse workers that have exited, re-queueing the zip a
+        worker was given if it died part way through. Workers over
+        WORKER_RSS_LIMIT are killed first.
+        """
+        crashed = []
+        requeue = []
+        with self.workers_lock:
+            for i, (worker, current, _, _) in enumerate(self.workers):
+                if worker.is_alive():
+                    rss = WORKER_RSS_LIMIT and process_rss(worker.pid)
+                    if not rss or rss <= WORKER_RSS_LIMIT:
                         continue
-                else:
-                    self.logger.warning('Unparsable zip found {}'
-                                        .format(parse_result['file_name']))
-
-                if self.delete_file(parse_result['file_name']):
-                    self.file_list.remove(parse_result['file_name'])
-                else:
-                    self.processed_queue.put(parse_result)
-                    self.logger.info('Added {} back to the processed queue'
-                                     .format(parse_result['file_name']))
+                    self.logger.warning('Killing {} using {} bytes RSS'
+                                        .format(worker.name, rss))
+                    try:
+                        os.kill(worker.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                worker.join()
+                file_name = current.value
+                self.start_worker(i)
+                self.worker_restarts.inc()
+                if not file_name:
+                    self.logger.info('Replaced {} after it exited with code '
+                                     '{}'.format(worker.name,
+                                                 worker.exitcode))
+                    continue
+                if worker.exitcode == 0:
+                    # Not the zip's doing, the worker left before taking it
+                    self.logger.warning('{} exited without parsing {}'
+                                        .format(worker.name, file_name))
+                    requeue.append(file_name)
+                    continue
+                self.logger.error('{} died with exit code {} while parsing '
+                                  '{}'.format(worker.name, worker.exitcode,
+                                              file_name))
+                crashed.append(file_name)
+
+        # Outside the lock, as the dispatch stage needs it to make room in the
+        # processing queue
+        for file_name in requeue:
+            if os.path.isfile(file_name):
+                self.processing_queue.put(file_name)
+                self.logger.info('Re-queued {}'.format(file_name))
+        for file_name in crashed:
+            self.worker_crashes.inc()
+            with self.file_list_lock:
+                crashes = self.crashes.get(file_name, 0) + 1
+                self.crashes[file_name] = crashes
+            if crashes > MAX_CRASHES:
+                # Treat it as unparsable so that it is removed
+                self.logger.error('Giving up on {} after {} crashes'
+                                  .format(file_name, crashes))
+                self.processed_queue.put({'file_name': file_name,
+                                          'result': None})
+            elif os.path.isfile(file_name):
+                self.processing_queue.put(file_name)
+                self.logger.info('Re-queued {}'.format(file_name))
 
+    def watch_stage(self):
+        """Queue new zips for the parse workers as they arrive"""
+        while True:
             self.trawl_directory()
 
-    def parse_to_json(self):
+    def dispatch_stage(self):
+        """Give queued zips to idle parse workers. A zip is recorded as the
+        worker's current one before the worker can take it, so that it is
+        re-queued wherever the worker dies.
+        """
+        while True:
+            file_name = self.processing_queue.get()
+            while True:
+                index, generation = self.idle_workers.get()
+                with self.workers_lock:
+                    worker, current, tasks, latest = self.workers[index]
+                    # A worker that died after saying it was idle leaves its
+                    # token behind, for a worker that is gone or replaced
+                    if generation != latest or not worker.is_alive():
+                        continue
+                    current.value = file_name
+                    tasks.put(file_name)
+                    break
+
+    def result_stage(self):
+        """Hand parse results from the workers to the BatchStore"""
+        while True:
+            parse_result = self.processed_queue.get()
+            if parse_result is None:
+                # There is no zip to remove without a file name
+                self.zips_failed.inc()
+                self.logger.warning('Empty parse result from a worker')
+                continue
+            if 'parse_seconds' in parse_result:
+                self.parse_seconds.observe(parse_result['parse_seconds'])
+                self.zip_bytes.inc(parse_result['size'])
+            for name, count in parse_result.get('cache', {}).iteritems():
+                self.parse_cache_counters[name].inc(count)
+            # If a result is None then there has been an error
+            # Don't bother trying to store this, but delete
+            # the file still
+            if parse_result['result'] is not None:
+                self.zips_parsed.inc()
+                self.encode_seconds.observe(parse_result['encode_seconds'])
+                key = 'Timeline::{}::{}::{}'.format(
+                    parse_result['uuid'], parse_result['collected_date'],
+                    parse_result['node_name'])
+                self.store.put(key, parse_result['result'],
+                               parse_result['file_name'])
+            else:
+                self.zips_failed.inc()
+                self.logger.warning('Unparsable zip found {}'
+                                    .format(parse_result['file_name']))
+                self.remove_zip(parse_result['file_name'])
+
+    def announce_stage(self):
+        """Write stored keys to Magic Bob and remove their zips"""
+        while True:
+            key, file_name, error = self.store.wait_completed()
+            if error is not None:
+                self.store_failed(file_name, error)
+                continue
+            while not self.announce(key, file_name):
+                time.sleep(RETRY_TIME)
+
+    def store_failed(self, file_name, error):
+        """Deal with a zip whose timeline the BatchStore gave up on. After a
+        temporary failure the zip is forgotten so that a later trawl parses
+        it again, otherwise it is removed as it can never be stored.
+        """
+        if error.temporary:
+            self.logger.warning('Gave up on storing the timeline of {} for '
+                                'now: {}'.format(file_name, error))
+            with self.file_list_lock:
+                self.file_list.discard(file_name)
+            return
+        self.zips_failed.inc()
+        self.logger.error('Unable to store the timeline of {}, removing it: '
+                          '{}'.format(file_name, error))
+        self.remove_zip(file_name)
+
+    def parse_to_json(self, index, generation, current, tasks):
+        """Parse zips from tasks until MAX_TASKS_PER_WORKER have been handled,
+        so that the memory left fragmented by large zips is handed back when
+        the worker exits.
+
+        current holds the zip the worker was given, set by the dispatch stage
+        so that it can be re-queued if the worker dies, and cleared once it
+        has been handled. The worker only says it is idle when it is about to
+        wait for a zip, never once it has handled its last.
+        """
+        reset_logging_locks()
+        self.metrics.close_after_fork()
         self.register_kill()
+        if WORKER_MEMORY_LIMIT:
+            resource.setrlimit(resource.RLIMIT_AS, (WORKER_MEMORY_LIMIT,
+                                                    WORKER_MEMORY_LIMIT))
         logger_process = logging.getLogger('timeline.manager.parser.{}'.format(
             multiprocessing.current_process().name))
-        while True:
-            file_name = self.processing_queue.get()
+        handled = 0
+        while not MAX_TASKS_PER_WORKER or handled < MAX_TASKS_PER_WORKER:
+            self.idle_workers.put((index, generation))
+            file_name = tasks.get()
+            handled += 1
             logger_process.info('Taken {} from the processing queue'
                                 .format(file_name))
             try:
-                timeline = self.work_function(file_name)
-            except Exception as e:
-                logger_process.warning('Error parsing zip-file: {}'
-                                       .format(e.message))
-                timeline = None
-                cluster_uuid = None
-                collected_date = None
-                my_node = None
-            else:
-                if timeline is None:
-                    continue
-
-                try:
-                    cluster_uuid = timeline.cluster_uuid
-                except AttributeError:
-                    cluster_uuid = '{}_no_cluster'.format(os.path
-                                                          .split(file_name)[1])
-                try:
-                    my_node = timeline.default_node_name
-                except AttributeError:
-                    logger_process.error('Unable to find node name of {}'
-                                         .format(file_name))
-                    self.processed_queue.put({'file_name': file_name,
-                                              'result': None})
-                    continue
-                else:
-                    if my_node[:5] == 'ns_1@':
-                        my_node = my_node[5:]
-
-                try:
-                    collected_date = timeline.collection_time
-                except AttributeError:
-                    logger_process.error('Unable to find collection time of {}'
-                                         .format(file_name))
-                    self.processed_queue.put({'file_name': file_name,
-                                              'result': None})
-                    continue
-
-                timeline = timeline.to_dict()
-                timeline['git_rev'] = self.git_rev
-
-            processed_object = {'file_name': file_name,
-                                'result': timeline,
-                                'uuid': cluster_uuid,
-                                'collected_date': collected_date,
-                                'node_name': my_node}
-            self.processed_queue.put(processed_object)
-            logger_process.info('Added {} to the processed queue'
-                                .format(file_name))
+                before = (self.cache.counters() if self.cache is not None
+                          else None)
+                processed_object = self.parse_file(file_name, logger_process)
+            except MemoryError:
+                # Leave current set so the zip is re-queued, the worker is
+                # in no state to carry on
+                logger_process.error('Ran out of memory parsing {}'
+                                     .format(file_name), exc_info=True)
+                os._exit(1)
+            if processed_object is not None:
+                if self.cache is not None:
+                    after = self.cache.counters()
+                    processed_object['cache'] = dict(
+                        (name, after[name] - before[name]) for name in after)
+                self.processed_queue.put(processed_object)
+                logger_process.info('Added {} to the processed queue'
+                                    .format(file_name))
+            current.value = ''
 
-    def store_parsed_log(self, doc, cluster_uuid, collected_date, my_node):
-        # Do storage here
-        key = 'Timeline::{}::{}::{}'.format(cluster_uuid, collected_date,
-                                            my_node)
-        if self.store_in_cb(key, doc):
-            result_path = os.path.join(
-                os.environ.get('DIR_MAGICBOB', '/magicbob'),
-                '{}.timeline'.format(str(uuid.uuid4()))
-            )
+    def parse_file(self, file_name, logger_process):
+        """Parse a zip into the object to put on the processed queue"""
+        stats = zip_stats() if self.stats else None
+        start = time.time()
+        try:
+            timeline = self.work_function(file_name, stats=stats)
+        except MemoryError:
+            raise
+        except Exception as e:
+            logger_process.warning('Error parsing zip-file: {}'
+                                   .format(e.message))
+            timeline = None
+            cluster_uuid = None
+            collected_date = None
+            my_node = None
+            parse_seconds = time.time() - start
+            encode_seconds = None
+        else:
+            parse_seconds = time.time() - start
+            if timeline is None:
+                return None
 
             try:
-                with open(result_path, 'w') as f:
-                    f.write(key)
-            except IOError:
-                self.logger.error('Failed to write key {} to Magic Bob'
-                                  .format(key), exc_info=True)
-                return False
+                cluster_uuid = timeline.cluster_uuid
+            except AttributeError:
+                cluster_uuid = '{}_no_cluster'.format(os.path
+                                                      .split(file_name)[1])
+            try:
+                my_node = timeline.default_node_name
+            except AttributeError:
+                logger_process.error('Unable to find node name of {}'
+                                     .format(file_name))
+                return {'file_name': file_name, 'result': None}
             else:
-                self.logger.info('Wrote key {} to Magic Bob'.format(key))
-                return True
+                if my_node[:5] == 'ns_1@':
+                    my_node = my_node[5:]
 
-    def file_action(self, file_name):
-        if file_name not in self.file_list:
             try:
-                # This prevent partial zip files from
-                # being parsed, e.g files being copied
-                # into the directory
-                zipfile.ZipFile(file_name, 'r')
-            except zipfile.BadZipfile:
-                self.logger.warning('Bad zip found - {}'
-                                    .format(file_name))
-            except IOError as e:
-                self.logger.info('IOError on {} - {}'.format(file_name,
-                                                             e.message))
+                collected_date = timeline.collection_time
+            except AttributeError:
+                logger_process.error('Unable to find collection time of {}'
+                                     .format(file_name))
+                return {'file_name': file_name, 'result': None}
+
+            extra = {'git_rev': self.git_rev}
+            if stats is not None:
+                extra['stats'] = stats
+                logger_process.info('Parsed {} in {:.2f}s'
+                                    .format(file_name, stats['seconds']))
+            start = time.time()
+            if STORE_FORMAT == 'compact':
+                timeline = timeline.to_compact(**extra)
             else:
-                self.processing_queue.put(file_name)
-                self.logger.info('Added {} to the processing queue'
-                                 .format(file_name))
-                self.file_list.append(file_name)
+                timeline = timeline.to_json(**extra)
+            encode_seconds = time.time() - start
+
+        try:
+            size = os.path.getsize(file_name)
+        except OSError:
+            size = 0
+        return {'file_name': file_name,
+                'result': timeline,
+                'uuid': cluster_uuid,
+                'collected_date': collected_date,
+                'node_name': my_node,
+                'parse_seconds': parse_seconds,
+                'encode_seconds': encode_seconds,
+                'size': size}
+
+    def announce(self, key, file_name):
+        """Tell Magic Bob about a stored key and remove the zip it came from"""
+        result_path = os.path.join(
+            os.environ.get('DIR_MAGICBOB', '/magicbob'),
+            '{}.timeline'.format(str(uuid.uuid4()))
+        )
+
+        start = time.time()
+        try:
+            with open(result_path, 'w') as f:
+                f.write(key)
+            self.magicbob_seconds.observe(time.time() - start)
+        except IOError:
+            self.logger.error('Failed to write key {} to Magic Bob'
+                              .format(key), exc_info=True)
+            return False
+        else:
+            self.logger.info('Wrote key {} to Magic Bob'.format(key))
+            self.remove_zip(file_name)
+            return True
+
+    def remove_zip(self, file_name):
+        if self.delete_file(file_name):
+            with self.file_list_lock:
+                self.file_list.discard(file_name)
+                self.crashes.pop(file_name, None)
+
+    def file_action(self, file_name):
+        with self.file_list_lock:
+            if file_name in self.file_list:
+                return
+        try:
+            # This prevent partial zip files from
+            # being parsed, e.g files being copied
+            # into the directory
+            zipfile.ZipFile(file_name, 'r')
+        except zipfile.BadZipfile:
+            self.logger.warning('Bad zip found - {}'
+                                .format(file_name))
+        except IOError as e:
+            self.logger.info('IOError on {} - {}'.format(file_name,
+                                                         e.message))
+        else:
+            with self.file_list_lock:
+                self.file_list.add(file_name)
+            # Blocks while the workers are busy
+            self.processing_queue.put(file_name)
+            self.logger.info('Added {} to the processing queue'
+                             .format(file_name))
 
     def kill(self, x, y):
         # Signal handlers for ctrl+c
@@ -259,13 +649,37 @@ class ParserManager(Manager):
 
 
 class CombinerManager(Manager):
-    def __init__(self, directory, result_func, git_rev):
+    def __init__(self, directory, result_func, git_rev, decode_func):
         super(CombinerManager, self).__init__(directory, '.snapshot',
                                               result_func, git_rev)
         self.logger = logging.getLogger('timeline.manager.combiner')
+        self.decode_function = decode_func
+        self.timeline_cache = TimelineCache()
+        self.register_metrics()
+        self.serve_metrics()
         while True:
             self.trawl_directory()
 
+    def register_metrics(self):
+        metrics = self.metrics
+        cache = self.timeline_cache
+        self.snapshots = metrics.counter('timeline_snapshots_total',
+                                         'Snapshots combined')
+        self.get_multi_seconds = metrics.histogram(
+            'timeline_get_multi_seconds',
+            'Time taken to fetch the timelines of a snapshot from Couchbase')
+        self.combine_seconds = metrics.histogram(
+            'timeline_combine_seconds',
+            'Time taken to combine the timelines of a snapshot')
+        metrics.gauge('timeline_cache_hit_rate',
+                      'Proportion of timelines found in the timeline cache',
+                      cache.hit_rate)
+        metrics.gauge('timeline_cache_timelines', 'Timelines in the cache',
+                      lambda: len(cache))
+        metrics.gauge('timeline_cache_bytes',
+                      'Estimated bytes held by the timeline cache',
+                      lambda: cache.size)
+
     def file_action(self, file_name):
         with open(file_name, 'r') as f:
             keys = f.read().split('\n')
@@ -273,20 +687,79 @@ class CombinerManager(Manager):
         keys = [key for key in keys if key]
 
         snapshot_key = keys[0]
-        timeline = self.work_function(
-            self.get_parsed_from_cb(keys[1:]))
+        timelines = self.get_timelines(keys[1:])
+        start = time.time()
+        timeline = self.work_function(timelines)
+        self.combine_seconds.observe(time.time() - start)
+        self.snapshots.inc()
         self.logger.debug('Result - {}'.format(timeline))
-        timeline = timeline.to_dict()
-        self.store_results(timeline, snapshot_key)
+        self.store_results(timeline.to_json(), snapshot_key)
         os.remove(file_name)
         self.logger.info('Removed file {}'.format(file_name))
 
+    def get_timelines(self, keys):
+        """Return the decoded timelines stored under keys. The CAS of every
+        key is observed first, and only the documents missing from the
+        timeline cache or changed since are fetched and decoded.
+        """
+        keys = list(set(keys))
+        cas = self.get_cas_from_cb(keys)
+        timelines = []
+        fetch = []
+        for key in keys:
+            timeline = self.timeline_cache.get(key, cas.get(key))
+            if timeline is None:
+                fetch.append(key)
+            else:
+                timelines.append(timeline)
+
+        if fetch:
+            docs = self.get_parsed_from_cb(fetch)
+            for key, doc in (docs or {}).iteritems():
+                timeline = self.decode_function(doc.value)
+                self.timeline_cache.put(key, doc.cas, timeline)
+                timelines.append(timeline)
+
+        self.logger.info('Fetched {} of {} timelines, cache hit rate {:.1%}, '
+                         '{} timelines taking {} bytes'
+                         .format(len(fetch), len(keys),
+                                 self.timeline_cache.hit_rate(),
+                                 len(self.timeline_cache),
+                                 self.timeline_cache.size))
+        return timelines
+
+    def get_cas_from_cb(self, keys):
+        """Observe the CAS of each key on its master node in one batch, which
+        returns no document bodies. Keys that cannot be observed are left
+        out, so they are fetched.
+        """
+        from couchbase.exceptions import CouchbaseError
+        try:
+            results = self.bucket.observe_multi(keys, master_only=True)
+        except CouchbaseError as e:
+            self.logger.debug('Unable to observe the CAS of some keys',
+                              exc_info=True)
+            results = getattr(e, 'all_results', None) or {}
+        cas = {}
+        for key, result in results.iteritems():
+            if not result.success:
+                continue
+            for info in result.value:
+                # A CAS of 0 is a key that was not found
+                if info.from_master and info.cas:
+                    cas[key] = info.cas
+        return cas
+
     def get_parsed_from_cb(self, keys):
+        """Fetch the documents stored under keys, returning a dict of the
+        results of those that were found.
+        """
         from couchbase.exceptions import TimeoutError
-        keys = list(set(keys))
         docs = None
+        start = time.time()
         try:
             docs = self.bucket.get_multi(keys, quiet=True)
+            self.get_multi_seconds.observe(time.time() - start)
         except TimeoutError:
             self.logger.warning('Timeout fetching keys {}, retrying'
                                 .format(keys))
@@ -306,16 +779,18 @@ class CombinerManager(Manager):
 
         if docs:
             self.logger.info('Loaded keys {} from CB'.format(keys))
-            try:
-                parse_results = [docs[key].value for key in keys
-                                 if docs[key].value]
-            except Exception:
-                self.logger.error('Failed to retrieve values for key {}'
-                                  .format(key), exc_info=True)
-            else:
-                return parse_results
+            parse_results = {}
+            for key in keys:
+                try:
+                    if docs[key].value:
+                        parse_results[key] = docs[key]
+                except Exception:
+                    self.logger.error('Failed to retrieve values for key {}'
+                                      .format(key), exc_info=True)
+            return parse_results
 
     def store_results(self, results, snapshot_name):
         key = 'Timeline::{}'.format(snapshot_name)
-        doc = {'git_rev': self.git_rev, 'results': results}
+        doc = EncodedJSON('{{"git_rev": {}, "results": {}}}'.format(
+            json.dumps(self.git_rev), results))
         self.store_in_cb(key, doc)
@@ -0,0 +1,193 @@
+import BaseHTTPServer
+import bisect
+import logging
+import threading
+
+"""
+Metrics for the Managers, served over HTTP in the Prometheus text format.
+
+A Registry holds counters, gauges and histograms. Counters and gauges can
+instead be given a function that is called for their value whenever the
+metrics are scraped, e.g. for the depth of a queue. Calling serve starts a
+thread answering GET /metrics with the current value of every metric.
+"""
+
+# Upper bounds in seconds of the buckets of a latency histogram
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in sorted(labels.iteritems())))
+
+
+class Metric(object):
+    type = 'untyped'
+
+    def __init__(self, name, description, func=None):
+        self.name = name
+        self.description = description
+        self.func = func
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """Return the (suffix, labels, value) of each sample"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                                            format_labels(labels),
+                                            format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, description, func=None):
+        super(Counter, self).__init__(name, description, func)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', None, self.func() if self.func else self.value)]
+
+
+class Gauge(Metric):
+    """A value that can go up and down. func may return a list of
+    (labels, value) for a gauge with a sample per label set.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, description, func=None):
+        super(Gauge, self).__init__(name, description, func)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.func() if self.func else self.value
+        if isinstance(value, list):
+            return [('', labels, sample) for labels, sample in value]
+        return [('', None, value)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description)
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], counts):
+            cumulative += count
+            samples.append(('_bucket', {'le': format_value(bound)},
+                            cumulative))
+        samples.append(('_sum', None, total))
+        samples.append(('_count', None, cumulative))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.logger = logging.getLogger('timeline.metrics')
+        self.metrics = []
+        self.server = None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, func=None):
+        return self.add(Counter(name, description, func))
+
+    def gauge(self, name, description, func=None):
+        return self.add(Gauge(name, description, func))
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, description, buckets))
+
+    def render(self):
+        output = []
+        for metric in self.metrics:
+            try:
+                output.append(metric.render())
+            except Exception:
+                # One broken metric should not hide the rest
+                self.logger.warning('Failed to render {}'.format(metric.name),
+                                    exc_info=True)
+        return '\n'.join(output) + '\n'
+
+    def serve(self, port, host=''):
+        """Serve the metrics on port from a daemon thread"""
+        self.server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self.server.registry = self
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='timeline.metrics')
+        thread.daemon = True
+        thread.start()
+        self.logger.info('Serving metrics on port {}'.format(port))
+        return thread
+
+    def close_after_fork(self):
+        """Close the listening socket inherited by a forked child, which
+        would otherwise keep the port open after the parent has exited.
+        """
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('timeline.metrics').debug(format % args)
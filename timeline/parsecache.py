@@ -0,0 +1,131 @@
+import cPickle as pickle
+import errno
+import hashlib
+import logging
+import os
+import zipfile
+
+"""
+An on-disk cache of parsed cbcollects, shared by the CLI and ParserManager.
+
+Entries are keyed by a hash of the central directory of the zip, i.e. the
+name, CRC32, size and date of every member, along with the git revision that
+parsed it, so re-uploads of the same collect hit the cache without having to
+be decompressed. The cache is bounded in size, evicting the least recently
+used entries first.
+
+Callers find the key of a zip once with key and pass it to both get and
+put, so a miss only reads the central directory once.
+"""
+
+# Default bound on the total size of the cache
+DEFAULT_MAX_SIZE = int(os.environ.get('TIMELINE_CACHE_SIZE', 1073741824))
+
+SUFFIX = '.parsed'
+
+
+class ParseCache(object):
+    def __init__(self, directory, git_rev, max_size=DEFAULT_MAX_SIZE):
+        self.logger = logging.getLogger('timeline.parsecache')
+        self.directory = directory
+        self.git_rev = git_rev
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, zip_file):
+        """Hash the central directory of zip_file, or return None if it
+        cannot be read.
+        """
+        try:
+            ci = zipfile.ZipFile(zip_file, 'r')
+        except (IOError, zipfile.BadZipfile):
+            return None
+        digest = hashlib.sha1(self.git_rev)
+        for info in ci.infolist():
+            digest.update('{}\0{}\0{}\0{}\0'.format(
+                info.filename, info.CRC, info.file_size, info.date_time))
+        ci.close()
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        """Return what was stored under key, or None on a miss"""
+        if key is not None:
+            path = self.path(key)
+            try:
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                pass
+            else:
+                # The modification time orders entries for eviction
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+                self.hits += 1
+                self.logger.debug('Cache hit for {} ({} hits, {} misses)'
+                                  .format(key, self.hits, self.misses))
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if key is None:
+            return False
+        path = self.path(key)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            # Rename so that other processes never see a partial entry
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            self.logger.warning('Failed to cache {}'.format(key),
+                                exc_info=True)
+            return False
+        self.evict()
+        return True
+
+    def counters(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_size.
+        """
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            else:
+                self.evictions += 1
+            total_size -= size
@@ -0,0 +1,75 @@
+"""
+Statistics on the parsing of cbcollects, gathered when --stats is given.
+
+Statistics are plain dicts so that they can be returned from worker
+processes and stored alongside a parsed timeline. For each zip they hold
+the time taken and, for each member, the bytes and lines scanned, the time
+spent scanning the log for hits and in the handlers of the searches, and the
+events emitted. Each search records its hits, events and handler time.
+"""
+
+MEGABYTE = 1048576.0
+
+
+def zip_stats():
+    return {'seconds': 0.0, 'cached': False, 'members': {}}
+
+
+def member_stats():
+    return {'bytes': 0, 'lines': 0, 'seconds': 0.0, 'scan_seconds': 0.0,
+            'handler_seconds': 0.0, 'events': 0, 'searches': {}}
+
+
+def search_stats(stats, name):
+    try:
+        return stats['searches'][name]
+    except KeyError:
+        return stats['searches'].setdefault(
+            name, {'hits': 0, 'events': 0, 'seconds': 0.0})
+
+
+def format_stats(all_stats):
+    """Format the statistics of each zip as a table, slowest members
+    first.
+    """
+    lines = []
+    row = '{:<48} {:>9} {:>10} {:>8} {:>8} {:>8}'
+    for zip_file, stats in sorted(all_stats.iteritems()):
+        lines.append('{} ({:.2f}s{})'.format(
+            zip_file, stats['seconds'], ', cached' if stats['cached'] else ''))
+        if not stats['members']:
+            continue
+        lines.append(row.format('  member / search', 'MB', 'lines',
+                                'scan s', 'hand. s', 'events'))
+        for logname, member in sorted(stats['members'].iteritems(),
+                                      key=lambda item: -item[1]['seconds']):
+            lines.append(row.format(
+                '  ' + logname, '{:.1f}'.format(member['bytes'] / MEGABYTE),
+                member['lines'], '{:.3f}'.format(member['scan_seconds']),
+                '{:.3f}'.format(member['handler_seconds']),
+                member['events']))
+            for name, search in sorted(member['searches'].iteritems(),
+                                       key=lambda item: -item[1]['seconds']):
+                lines.append(row.format(
+                    '    {} ({} hits)'.format(name, search['hits']), '', '',
+                    '', '{:.3f}'.format(search['seconds']),
+                    search['events']))
+    return '\n'.join(lines)
+
+
+def format_cache_stats(counters):
+    """Format the counters of a ParseCache"""
+    return 'Parse cache: {hits} hits, {misses} misses, {evictions} ' \
+        'evictions'.format(**counters)
+
+
+def get_member_stats(stats, logname):
+    """Return the statistics of a member from those of its zip, or None if
+    statistics are not being gathered.
+    """
+    if stats is None:
+        return None
+    try:
+        return stats['members'][logname]
+    except KeyError:
+        return stats['members'].setdefault(logname, member_stats())
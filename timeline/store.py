@@ -0,0 +1,319 @@
+import heapq
+import logging
+import os
+import Queue
+import threading
+import time
+
+"""
+A storage stage that writes documents to Couchbase in batches.
+
+Documents are handed to a BatchStore, which upserts them from a thread of its
+own with upsert_multi, flushing whenever BATCH_SIZE documents are waiting or
+the oldest has waited FLUSH_INTERVAL seconds. Keys that fail are retried with
+exponential backoff alongside new documents, rather than holding them up.
+Only temporary failures are retried, and only MAX_ATTEMPTS times, anything
+else is handed back as failed. A key is only ever waiting on one retry,
+holding the newest doc put for it, so an older doc can not land after a newer
+one.
+Admission is bounded by MAX_PENDING, so a slow or unavailable cluster pushes
+back on whoever is adding documents.
+
+Anything with an upsert_multi method can be used as the bucket, e.g. the
+in-process MemoryBucket.
+"""
+
+BATCH_SIZE = int(os.environ.get('TIMELINE_STORE_BATCH_SIZE', 32))
+FLUSH_INTERVAL = float(os.environ.get('TIMELINE_STORE_FLUSH_INTERVAL', 1))
+MAX_PENDING = int(os.environ.get('TIMELINE_STORE_MAX_PENDING', 128))
+
+# Backoff between retries of a failed key, doubling up to RETRY_MAX
+RETRY_BASE = 1
+RETRY_MAX = 300
+# Attempts at storing a key before giving up on it
+MAX_ATTEMPTS = int(os.environ.get('TIMELINE_STORE_MAX_ATTEMPTS', 10))
+
+
+def is_temporary(error):
+    """Whether a failure to store is worth retrying. error is either the
+    exception raised by upsert_multi for a whole batch or the failed result
+    of one key. Anything with a temporary attribute, as from MemoryBucket,
+    says so itself, failures from the Couchbase SDK are told apart by type.
+    """
+    temporary = getattr(error, 'temporary', None)
+    if temporary is not None:
+        return temporary
+    try:
+        from couchbase.exceptions import (CouchbaseError,
+                                          CouchbaseNetworkError,
+                                          TemporaryFailError, TimeoutError)
+    except ImportError:
+        return False
+    if isinstance(error, Exception):
+        error_type = type(error)
+    else:
+        error_type = CouchbaseError.rc_to_exctype(error.rc)
+    return issubclass(error_type, (CouchbaseNetworkError, TemporaryFailError,
+                                   TimeoutError))
+
+
+class StoreError(Exception):
+    """Raised by upsert_multi when some keys failed to store, all_results
+    maps every key to a result with a success attribute as in the Couchbase
+    SDK.
+    """
+    def __init__(self, message, all_results):
+        super(StoreError, self).__init__(message)
+        self.all_results = all_results
+
+
+class StoreFailed(Exception):
+    """Handed back by a BatchStore for a document it gave up on, temporary is
+    whether the failure could go away if the document was put again.
+    """
+    def __init__(self, key, error, temporary):
+        super(StoreFailed, self).__init__(
+            'Failed to store key `{}`: {}'.format(key, error))
+        self.error = error
+        self.temporary = temporary
+
+
+class Result(object):
+    def __init__(self, success, temporary=True):
+        self.success = success
+        self.temporary = temporary
+
+
+class MemoryBucket(object):
+    """An in-process stand in for a Couchbase bucket.
+
+    Keys in fail_keys fail to store as many times as their count, with a
+    temporary failure. Keys in reject_keys always fail, permanently.
+    """
+    def __init__(self):
+        self.docs = {}
+        self.fail_keys = {}
+        self.reject_keys = set()
+        self.lock = threading.Lock()
+
+    def upsert_multi(self, docs):
+        with self.lock:
+            results = {}
+            for key, doc in docs.iteritems():
+                if key in self.reject_keys:
+                    results[key] = Result(False, temporary=False)
+                elif self.fail_keys.get(key, 0) > 0:
+                    self.fail_keys[key] -= 1
+                    results[key] = Result(False)
+                else:
+                    self.docs[key] = doc
+                    results[key] = Result(True)
+            if not all(result.success for result in results.itervalues()):
+                raise StoreError('Failed to store some keys', results)
+            return results
+
+
+class Entry(object):
+    """A doc waiting to be stored, with the context of every put it stands
+    for
+    """
+    __slots__ = ('key', 'doc', 'contexts', 'sequence', 'attempts', 'due')
+
+    def __init__(self, key, doc, context, sequence):
+        self.key = key
+        self.doc = doc
+        self.contexts = [context]
+        # Order in which the doc was put, the highest is the newest
+        self.sequence = sequence
+        self.attempts = 0
+        # When a retry is due
+        self.due = None
+
+    def merge(self, other):
+        """Take on the puts of another entry for the same key, keeping the
+        newest doc
+        """
+        if other.sequence > self.sequence:
+            self.doc = other.doc
+            self.sequence = other.sequence
+        self.contexts.extend(other.contexts)
+        self.attempts = max(self.attempts, other.attempts)
+        return self
+
+
+class BatchStore(object):
+    def __init__(self, bucket, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING,
+                 max_attempts=MAX_ATTEMPTS, latency=None):
+        self.logger = logging.getLogger('timeline.store')
+        self.bucket = bucket
+        # Histogram of the time taken by each upsert_multi, if any
+        self.latency = latency
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.pending = Queue.Queue(max_pending)
+        self.stored = Queue.Queue()
+        # Heap of (due time, key) of retries, those whose key is no longer
+        # retrying at that time are skipped
+        self.retries = []
+        # The Entry of each key waiting to be retried
+        self.retrying = {}
+        self.sequence = 0
+        self.retry_count = 0
+        # Documents put but not yet stored
+        self.unstored = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run,
+                                       name='timeline.store')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, key, doc, context=None, timeout=None):
+        """Queue doc to be stored as key, blocking while MAX_PENDING documents
+        are already waiting. context is handed back by completed().
+        """
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+        self.pending.put(Entry(key, doc, context, sequence), timeout=timeout)
+        with self.lock:
+            self.unstored += 1
+
+    def completed(self):
+        """Return the (key, context, error) of each document stored or given
+        up on since the last call, error is None unless it is a StoreFailed.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.stored.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def wait_completed(self, timeout=None):
+        """Wait for the next document to be stored or given up on and return
+        its (key, context, error).
+        """
+        return self.stored.get(timeout=timeout)
+
+    def outstanding(self):
+        """Whether any documents are waiting to be stored"""
+        with self.lock:
+            return self.unstored > 0
+
+    def next_batch(self):
+        """Gather entries until there are batch_size of them or the first has
+        waited flush_interval seconds. Retries that are due go first.
+        """
+        batch = []
+        now = time.time()
+        while self.retries and self.retries[0][0] <= now and \
+                len(batch) < self.batch_size:
+            due, key = heapq.heappop(self.retries)
+            entry = self.retrying.get(key)
+            if entry is None or entry.due != due:
+                # A newer doc for the key was stored in the meantime
+                continue
+            del self.retrying[key]
+            batch.append(entry)
+
+        deadline = None
+        while len(batch) < self.batch_size:
+            if batch and deadline is None:
+                deadline = time.time() + self.flush_interval
+            if deadline is None:
+                timeout = self.flush_interval
+                if self.retries:
+                    timeout = max(0, min(timeout,
+                                         self.retries[0][0] - time.time()))
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+            try:
+                entry = self.pending.get(timeout=timeout)
+            except Queue.Empty:
+                if batch or (self.retries and
+                             self.retries[0][0] <= time.time()):
+                    break
+                continue
+            batch.append(entry)
+        return batch
+
+    def flush(self, entries):
+        """Store the entries of a dict of key to Entry, returning a dict of
+        the keys that failed to their errors.
+        """
+        start = time.time()
+        try:
+            self.bucket.upsert_multi(dict((key, entry.doc) for key, entry
+                                          in entries.iteritems()))
+        except Exception as e:
+            all_results = getattr(e, 'all_results', None)
+            if all_results is None:
+                self.logger.warning('Failed to store {} keys'
+                                    .format(len(entries)), exc_info=True)
+                return dict((key, e) for key in entries)
+            return dict((key, result) for key, result
+                        in all_results.iteritems() if not result.success)
+        finally:
+            if self.latency is not None:
+                self.latency.observe(time.time() - start)
+        return {}
+
+    def complete(self, entry, error=None):
+        """Hand back every put an entry stands for"""
+        with self.lock:
+            self.unstored -= len(entry.contexts)
+        for context in entry.contexts:
+            self.stored.put((entry.key, context, error))
+
+    def retry(self, entry):
+        existing = self.retrying.get(entry.key)
+        if existing is not None:
+            # Ride along with the retry already waiting for the key
+            existing.merge(entry)
+            return
+        delay = min(RETRY_BASE * 2 ** (entry.attempts - 1), RETRY_MAX)
+        self.logger.warning('Failed to store key `{}` in Couchbase, '
+                            'retrying in {}s'.format(entry.key, delay))
+        self.retry_count += 1
+        entry.due = time.time() + delay
+        self.retrying[entry.key] = entry
+        heapq.heappush(self.retries, (entry.due, entry.key))
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            # Puts of the same key are stored once, as the newest doc
+            entries = {}
+            for entry in batch:
+                merged = entries.get(entry.key)
+                entries[entry.key] = (entry if merged is None
+                                      else merged.merge(entry))
+            failed = self.flush(entries)
+            for key, entry in entries.iteritems():
+                error = failed.get(key)
+                if error is None:
+                    self.complete(entry)
+                    older = self.retrying.get(key)
+                    if older is not None and older.sequence < entry.sequence:
+                        # Its doc must not overwrite the one just stored
+                        del self.retrying[key]
+                        self.complete(older)
+                    continue
+                entry.attempts += 1
+                temporary = is_temporary(error)
+                if temporary and entry.attempts < self.max_attempts:
+                    self.retry(entry)
+                    continue
+                self.logger.error('Giving up on storing key `{}` in '
+                                  'Couchbase after {} attempts: {}'
+                                  .format(key, entry.attempts, error))
+                self.complete(entry, StoreFailed(key, error, temporary))
+            self.logger.info('Stored {} of {} keys in CB'
+                             .format(len(entries) - len(failed),
+                                     len(entries)))
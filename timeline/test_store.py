@@ -0,0 +1,81 @@
+import time
+import unittest
+
+import store
+from store import BatchStore, MemoryBucket, StoreFailed
+
+
+class BatchStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.retry_base = store.RETRY_BASE
+        store.RETRY_BASE = 0.01
+        self.bucket = MemoryBucket()
+        self.store = BatchStore(self.bucket, batch_size=8,
+                                flush_interval=0.05, max_attempts=3)
+
+    def tearDown(self):
+        store.RETRY_BASE = self.retry_base
+
+    def wait_all(self, count):
+        return sorted(self.store.wait_completed(timeout=5)
+                      for _ in range(count))
+
+    def test_same_key_twice_completes_both(self):
+        self.store.put('key', {'n': 1}, context='first')
+        self.store.put('key', {'n': 2}, context='second')
+        self.assertEqual(self.wait_all(2), [('key', 'first', None),
+                                            ('key', 'second', None)])
+        self.assertFalse(self.store.outstanding())
+        self.assertEqual(self.store.unstored, 0)
+        self.assertEqual(self.bucket.docs, {'key': {'n': 2}})
+
+    def test_temporary_failure_is_retried(self):
+        self.bucket.fail_keys['bad'] = 2
+        self.store.put('good', 1, context='g')
+        self.store.put('bad', 2, context='b')
+        self.assertEqual(self.wait_all(2), [('bad', 'b', None),
+                                            ('good', 'g', None)])
+        self.assertFalse(self.store.outstanding())
+        self.assertEqual(self.store.retry_count, 2)
+        self.assertEqual(self.bucket.docs, {'good': 1, 'bad': 2})
+
+    def test_permanent_failure_is_given_up_on(self):
+        self.bucket.reject_keys.add('bad')
+        self.store.put('bad', 1, context='b')
+        key, context, error = self.store.wait_completed(timeout=5)
+        self.assertEqual((key, context), ('bad', 'b'))
+        self.assertIsInstance(error, StoreFailed)
+        self.assertFalse(error.temporary)
+        self.assertEqual(self.store.retry_count, 0)
+        self.assertFalse(self.store.outstanding())
+        self.assertEqual(self.store.retrying, {})
+
+    def test_temporary_failure_gives_up_after_max_attempts(self):
+        self.bucket.fail_keys['bad'] = 10
+        self.store.put('bad', 1, context='b')
+        key, context, error = self.store.wait_completed(timeout=5)
+        self.assertIsInstance(error, StoreFailed)
+        self.assertTrue(error.temporary)
+        self.assertEqual(self.store.retry_count, 2)
+        self.assertEqual(self.bucket.fail_keys['bad'], 7)
+        self.assertFalse(self.store.outstanding())
+
+    def test_older_retry_does_not_overwrite_newer_doc(self):
+        store.RETRY_BASE = 0.5
+        self.bucket.fail_keys['key'] = 1
+        self.store.put('key', 'old', context='first')
+        deadline = time.time() + 5
+        while not self.store.retrying and time.time() < deadline:
+            time.sleep(0.01)
+        self.store.put('key', 'new', context='second')
+        self.assertEqual(self.wait_all(2), [('key', 'first', None),
+                                            ('key', 'second', None)])
+        self.assertEqual(self.store.retrying, {})
+        # Past the time the old doc's retry was due
+        time.sleep(0.6)
+        self.assertEqual(self.bucket.docs, {'key': 'new'})
+        self.assertFalse(self.store.outstanding())
+
+
+if __name__ == '__main__':
+    unittest.main()
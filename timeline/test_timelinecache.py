@@ -0,0 +1,127 @@
+import json
+import logging
+import unittest
+
+import main
+from main import Timeline, decode_timeline
+from manager import CombinerManager
+from timelinecache import TimelineCache, timeline_size
+from utils import Event
+
+
+class Result(object):
+    def __init__(self, value, cas):
+        self.value = value
+        self.cas = cas
+
+
+def node_timeline(node_name, count=5):
+    timeline = Timeline()
+    timeline.events = [
+        Event.from_fields(1420070400000000 + i * 1000000, 0, node_name,
+                          'Rebalance', 'Started rebalance {}'.format(i))
+        for i in range(count)]
+    return timeline
+
+
+class TimelineCacheTest(unittest.TestCase):
+    def test_cas_mismatch_is_a_miss(self):
+        cache = TimelineCache()
+        timeline = node_timeline('10.0.0.1')
+        cache.put('key', 1, timeline)
+        self.assertIs(cache.get('key', 1), timeline)
+        self.assertIsNone(cache.get('key', 2))
+        self.assertIsNone(cache.get('key', None))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        # The changed document was dropped
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_least_recently_used_is_evicted_by_bytes(self):
+        size = timeline_size(node_timeline('10.0.0.1'))
+        cache = TimelineCache(max_size=2 * size)
+        for node_name in ['10.0.0.1', '10.0.0.2']:
+            cache.put(node_name, 1, node_timeline(node_name))
+        # Use the first, so the second is the least recently used
+        self.assertIsNotNone(cache.get('10.0.0.1', 1))
+        cache.put('10.0.0.3', 1, node_timeline('10.0.0.3'))
+        self.assertEqual(list(cache.entries), ['10.0.0.1', '10.0.0.3'])
+        self.assertEqual(cache.size, 2 * size)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_too_large_is_not_cached(self):
+        cache = TimelineCache(max_size=10)
+        self.assertFalse(cache.put('key', 1, node_timeline('10.0.0.1')))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.max_result_size = main.MAX_RESULT_SIZE
+
+    def tearDown(self):
+        main.MAX_RESULT_SIZE = self.max_result_size
+
+    def test_round_trip(self):
+        timeline = node_timeline('10.0.0.1')
+        document = json.loads(str(timeline.to_compact(git_rev='abc')))
+        self.assertEqual(document['git_rev'], 'abc')
+        decoded = decode_timeline(document)
+        self.assertEqual([event.to_dict() for event in decoded.events],
+                         [event.to_dict() for event in timeline.events])
+
+    def test_newest_events_kept_within_budget(self):
+        timeline = node_timeline('10.0.0.1', count=2000)
+        main.MAX_RESULT_SIZE = 2000
+        document = str(timeline.to_compact())
+        self.assertLessEqual(len(document), main.MAX_RESULT_SIZE)
+        decoded = decode_timeline(json.loads(document))
+        kept = len(decoded.events)
+        self.assertTrue(0 < kept < 2000)
+        self.assertEqual([event.to_dict() for event in decoded.events],
+                         [event.to_dict()
+                          for event in timeline.events[-kept:]])
+
+
+class CombinerCacheTest(unittest.TestCase):
+    def setUp(self):
+        # The CombinerManager constructor trawls forever, so only the state
+        # get_timelines uses is set up
+        self.manager = CombinerManager.__new__(CombinerManager)
+        self.manager.logger = logging.getLogger('timeline.test')
+        self.manager.timeline_cache = TimelineCache()
+        self.manager.decode_function = decode_timeline
+        self.docs = {}
+        self.fetched = []
+        self.manager.get_cas_from_cb = lambda keys: dict(
+            (key, self.docs[key].cas) for key in keys if key in self.docs)
+        self.manager.get_parsed_from_cb = self.get_parsed
+
+    def get_parsed(self, keys):
+        self.fetched.extend(keys)
+        return dict((key, self.docs[key]) for key in keys if key in self.docs)
+
+    def store(self, key, timeline, cas):
+        document = json.loads(str(timeline.to_compact(git_rev='abc')))
+        self.docs[key] = Result(document, cas)
+
+    def test_unchanged_compact_documents_are_not_fetched(self):
+        for node_name in ['10.0.0.1', '10.0.0.2']:
+            self.store(node_name, node_timeline(node_name), 1)
+        first = self.manager.get_timelines(list(self.docs))
+        self.assertEqual(sorted(self.fetched), ['10.0.0.1', '10.0.0.2'])
+        second = self.manager.get_timelines(list(self.docs))
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual(sorted(map(id, first)), sorted(map(id, second)))
+
+    def test_rewritten_document_is_fetched_again(self):
+        self.store('key', node_timeline('10.0.0.1'), 1)
+        self.manager.get_timelines(['key'])
+        self.store('key', node_timeline('10.0.0.9'), 2)
+        timelines = self.manager.get_timelines(['key'])
+        self.assertEqual(self.fetched, ['key', 'key'])
+        self.assertEqual(timelines[0].events[0].node_name, '10.0.0.9')
+
+
+if __name__ == '__main__':
+    unittest.main()
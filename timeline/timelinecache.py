@@ -0,0 +1,82 @@
+import collections
+import logging
+import os
+
+"""
+An in-memory cache of decoded per-node timelines for the CombinerManager.
+
+Successive snapshots of a cluster share nearly all of their node timelines,
+so decoded timelines are kept between snapshots keyed by their document key
+along with its CAS. A document that has been rewritten since it was cached
+has a new CAS and misses. The cache is bounded by an estimate of the memory
+held, evicting the least recently used timelines first.
+"""
+
+# Default bound on the memory held by the cache in bytes
+DEFAULT_MAX_SIZE = int(os.environ.get('TIMELINE_COMBINER_CACHE_SIZE',
+                                      268435456))
+
+# Rough size in bytes of an Event and the strings it holds, not counting the
+# characters of its description
+EVENT_SIZE = 160
+
+
+def timeline_size(timeline):
+    """Estimate the memory held by the events of a timeline"""
+    return sum(EVENT_SIZE + len(event.description)
+               for event in timeline.events)
+
+
+class TimelineCache(object):
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.logger = logging.getLogger('timeline.timelinecache')
+        self.max_size = max_size
+        # Maps key to (cas, timeline, size), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, cas):
+        """Return the timeline cached for key if it was stored with cas,
+        otherwise None.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            if cas is not None and entry[0] == cas:
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            # The document has changed since it was cached
+            self.size -= entry[2]
+        self.misses += 1
+        return None
+
+    def put(self, key, cas, timeline):
+        self.discard(key)
+        size = timeline_size(timeline)
+        if size > self.max_size:
+            self.logger.debug('{} is too large to cache'.format(key))
+            return False
+        self.entries[key] = (cas, timeline, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+        return True
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def __len__(self):
+        return len(self.entries)
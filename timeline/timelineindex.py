@@ -0,0 +1,80 @@
+import bisect
+import heapq
+
+"""
+An index of the events of a sorted Timeline by time, node and type.
+
+For each node, and each type of event on that node, the index holds the
+epochs of the events along with their positions in the timeline, both in
+order. The events of one node and type within a time range are found by
+bisecting its epochs, and a query over several nodes or types merges the
+ranges found for each, so a query costs O(log n + k) for k matching events
+rather than a scan of every event.
+"""
+
+
+def window(epochs, since=None, until=None):
+    """Return the slice of sorted epochs between since and until inclusive"""
+    start = 0 if since is None else bisect.bisect_left(epochs, since)
+    stop = len(epochs) if until is None else bisect.bisect_right(epochs,
+                                                                 until)
+    return start, stop
+
+
+class TimelineIndex(object):
+    def __init__(self, events):
+        """events must already be sorted"""
+        self.events = events
+        self.size = len(events)
+        self.epochs = [event.epoch for event in events]
+        # node name -> type -> (epochs, positions)
+        self.nodes = {}
+        for position, event in enumerate(events):
+            types = self.nodes.get(event.node_name)
+            if types is None:
+                types = self.nodes[event.node_name] = {}
+            entry = types.get(event.type)
+            if entry is None:
+                entry = types[event.type] = ([], [])
+            entry[0].append(event.epoch)
+            entry[1].append(position)
+
+    def is_current(self, events):
+        """Whether the index is still of events"""
+        return events is self.events and len(events) == self.size
+
+    def entries(self, nodes=None, types=None):
+        """Yield the (epochs, positions) of each node and type queried"""
+        if nodes is None:
+            nodes = self.nodes
+        for node in nodes:
+            node_types = self.nodes.get(node)
+            if node_types is None:
+                continue
+            if types is None:
+                for entry in node_types.itervalues():
+                    yield entry
+            else:
+                for event_type in types:
+                    entry = node_types.get(event_type)
+                    if entry is not None:
+                        yield entry
+
+    def query(self, since=None, until=None, nodes=None, types=None):
+        """Return the events between since and until on any of nodes and of
+        any of types, in order. None matches anything.
+        """
+        if nodes is None and types is None:
+            start, stop = window(self.epochs, since, until)
+            return self.events[start:stop]
+
+        runs = []
+        for epochs, positions in self.entries(nodes, types):
+            start, stop = window(epochs, since, until)
+            if start < stop:
+                runs.append(positions[start:stop])
+        if len(runs) == 1:
+            positions = runs[0]
+        else:
+            positions = heapq.merge(*runs)
+        return [self.events[position] for position in positions]
@@ -1,23 +1,74 @@
+import datetime
 import re
-from dateutil.parser import parse
-from dateutil.tz import tzutc
 
 pat_time = re.compile(r'(([0-9]{4}-[0-9]{2}-[0-9]{2}[T ]?[0-9][0-9]*:[0-9]{2}:'
                       '[0-9]{2}\.[0-9]{3})([-+][0-9]{2}:[0-9]{2})?)')
 pat_nodename1 = re.compile(r'ns_1@([%!~\-_\*\.\w]+)')
 pat_nodename2 = re.compile(r'([^\s]+@127.0.0.1)')
+# The timestamp formats found in the logs and produced by isoformat()
+pat_iso_time = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})[T ]?([0-9]{1,2}):'
+                          r'([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,6}))?'
+                          '(?:([-+])([0-9]{2}):?([0-9]{2})|Z)?$')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+_tz_cache = {}
+
+
+class FixedOffset(datetime.tzinfo):
+    """A tzinfo with a fixed offset from UTC, see get_tz"""
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self._offset = datetime.timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+    def __reduce__(self):
+        # Unpickle to the shared instance for this offset
+        return get_tz, (self.minutes,)
+
+    def __repr__(self):
+        return 'FixedOffset({})'.format(self.minutes)
+
+
+def get_tz(minutes):
+    """Return the shared tzinfo for an offset from UTC given in minutes"""
+    try:
+        return _tz_cache[minutes]
+    except KeyError:
+        return _tz_cache.setdefault(minutes, FixedOffset(minutes))
+
+
+class EncodedJSON(str):
+    """A document that has already been encoded as JSON"""
 
 
 class Event(object):
+    # Events are held by the million when combining clusters, so the timestamp
+    # is kept as integer microseconds since the epoch plus the UTC offset in
+    # minutes, the datetime is only built when rendering
+    __slots__ = ('epoch', 'offset', 'node_name', 'type', 'description')
+
+    str_format = '{0:<26} {1:^{width}} {2}'
+    node_width = 20
+
     def __init__(self, line=None, event_type=None, description=None,
                  default_node_name=None, node_name=None, input_dict=None):
         if input_dict:
-            self.timestamp = parse(input_dict['timestamp'])
+            self.epoch, self.offset = parse_epoch(input_dict['timestamp'])
             self.node_name = input_dict['node_name']
             self.type = input_dict['type']
             self.description = input_dict['description']
         else:
-            self.timestamp = extract_time(line)
+            self.epoch, self.offset = extract_epoch(line)
             # In the general case it is more convenient to
             # automatically parse the node name from the line
             # However in the case of diag, this does not work
@@ -30,18 +81,22 @@ class Event(object):
             self.type = event_type
             self.description = description
 
-        # It's possible that the timestamp has no offset in it
-        # However, we still want to be able to compare these
-        # timestamps with others which may have offsets in
-        # We could do this conversion in the parsing of the timestamp
-        # but we now have bad timestamps out in the wild so it's
-        # easier to fix it here
-        if not self.timestamp.tzinfo:
-            # Due to no other info, assume it is UTC
-            self.timestamp = self.timestamp.replace(tzinfo=tzutc())
+    @classmethod
+    def from_fields(cls, epoch, offset, node_name, event_type, description):
+        """Build an Event from a timestamp already split into epoch and
+        offset, as read back from a compact timeline.
+        """
+        event = cls.__new__(cls)
+        event.epoch = epoch
+        event.offset = offset
+        event.node_name = node_name
+        event.type = event_type
+        event.description = description
+        return event
 
-        self.node_width = 20
-        self.str_format = '{0:<26} {1:^{width}} {2}'
+    @property
+    def timestamp(self):
+        return epoch_to_time(self.epoch, self.offset)
 
     def to_dict(self):
         return {'timestamp': self.timestamp.isoformat(),
@@ -49,39 +104,190 @@ class Event(object):
                 'type': self.type,
                 'description': self.description}
 
+    def full_description(self):
+        """The description along with anything else worth showing"""
+        return self.description
+
+    def format(self, node_width=None):
+        return self.str_format.format(self.timestamp.isoformat(),
+                                      self.node_name, self.description,
+                                      width=node_width or self.node_width)
+
     def __cmp__(self, other):
         if isinstance(other, Event):
-            if self.timestamp < other.timestamp:
-                return -1
-            elif self.timestamp == other.timestamp:
-                return 0
-            else:
-                return 1
+            return cmp(self.epoch, other.epoch)
+        else:
+            raise TypeError
+
+    def __lt__(self, other):
+        if isinstance(other, Event):
+            return self.epoch < other.epoch
         else:
             raise TypeError
 
     def __str__(self):
-        return self.str_format.format(self.timestamp.isoformat(),
-                                      self.node_name, self.description,
-                                      width=self.node_width)
+        return self.format()
 
     def __hash__(self):
-        return (hash(self.timestamp) + hash(self.description) +
+        return (hash(self.epoch) + hash(self.description) +
                 hash(self.node_name))
 
     def __eq__(self, other):
         if isinstance(other, Event):
-            return (self.timestamp == other.timestamp and
+            return (self.epoch == other.epoch and
                     self.description == other.description)
         else:
             raise TypeError
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return (self.epoch, self.offset, self.node_name, self.type,
+                self.description)
+
+    def __setstate__(self, state):
+        (self.epoch, self.offset, self.node_name, self.type,
+         self.description) = state
+
 
-def extract_time(line):
+class BurstEvent(Event):
+    """A run of events with the same node, type and description merged into
+    one. The timestamp is that of the first event in the run and
+    last_epoch and last_offset are those of the last.
+    """
+    __slots__ = ('count', 'last_epoch', 'last_offset')
+
+    @classmethod
+    def from_event(cls, event):
+        burst = cls.from_fields(event.epoch, event.offset, event.node_name,
+                                event.type, event.description)
+        burst.count = 1
+        burst.last_epoch = event.epoch
+        burst.last_offset = event.offset
+        return burst
+
+    def merge(self, event):
+        self.count += 1
+        if event.epoch < self.epoch:
+            self.epoch, self.offset = event.epoch, event.offset
+        if event.epoch > self.last_epoch:
+            self.last_epoch, self.last_offset = event.epoch, event.offset
+
+    @property
+    def last_timestamp(self):
+        return epoch_to_time(self.last_epoch, self.last_offset)
+
+    def to_dict(self):
+        event_dict = super(BurstEvent, self).to_dict()
+        event_dict['count'] = self.count
+        event_dict['last_timestamp'] = self.last_timestamp.isoformat()
+        return event_dict
+
+    def full_description(self):
+        return '{} (x{} until {})'.format(self.description, self.count,
+                                          self.last_timestamp.isoformat())
+
+    def format(self, node_width=None):
+        return self.str_format.format(self.timestamp.isoformat(),
+                                      self.node_name, self.full_description(),
+                                      width=node_width or self.node_width)
+
+    def __getstate__(self):
+        return super(BurstEvent, self).__getstate__() + (
+            self.count, self.last_epoch, self.last_offset)
+
+    def __setstate__(self, state):
+        super(BurstEvent, self).__setstate__(state[:5])
+        self.count, self.last_epoch, self.last_offset = state[5:]
+
+
+def event_from_dict(event_dict):
+    """Build an Event, or a BurstEvent for a merged run, from to_dict"""
+    event = Event(input_dict=event_dict)
+    if 'count' in event_dict:
+        event = BurstEvent.from_event(event)
+        event.count = event_dict['count']
+        event.last_epoch, event.last_offset = parse_epoch(
+            event_dict['last_timestamp'])
+    return event
+
+
+def extract_epoch(line):
     match = pat_time.search(line)
-    t = match.group(1)
-    time = parse(t)
-    return time
+    return parse_epoch(match.group(1))
+
+
+def parse_time(string):
+    """Parse a timestamp as found in the logs or produced by isoformat()
+
+    The formats we produce and find in the logs are handled directly, anything
+    else is left to dateutil.
+    """
+    m = pat_iso_time.match(string)
+    if not m:
+        from dateutil.parser import parse
+        return parse(string)
+
+    (year, month, day, hour, minute, second, fraction,
+     sign, offset_hours, offset_minutes) = m.groups()
+    if fraction:
+        microsecond = int(fraction.ljust(6, '0'))
+    else:
+        microsecond = 0
+    if sign:
+        offset = int(offset_hours) * 60 + int(offset_minutes)
+        tz = get_tz(-offset if sign == '-' else offset)
+    elif string.endswith('Z'):
+        tz = get_tz(0)
+    else:
+        tz = None
+    return datetime.datetime(int(year), int(month), int(day), int(hour),
+                             int(minute), int(second), microsecond, tz)
+
+
+def parse_epoch(string):
+    """Parse a timestamp to microseconds since the epoch and its UTC offset in
+    minutes. Timestamps without an offset are assumed to be UTC.
+    """
+    m = pat_iso_time.match(string)
+    if not m:
+        return time_to_epoch(parse_time(string))
+
+    (year, month, day, hour, minute, second, fraction,
+     sign, offset_hours, offset_minutes) = m.groups()
+    if sign:
+        offset = int(offset_hours) * 60 + int(offset_minutes)
+        if sign == '-':
+            offset = -offset
+    else:
+        offset = 0
+    seconds = ((datetime.date(int(year), int(month), int(day)).toordinal() -
+                EPOCH_ORDINAL) * 86400 + int(hour) * 3600 +
+               (int(minute) - offset) * 60 + int(second))
+    if fraction:
+        return seconds * 1000000 + int(fraction.ljust(6, '0')), offset
+    return seconds * 1000000, offset
+
+
+def time_to_epoch(time):
+    """Convert a datetime to microseconds since the epoch and its UTC offset
+    in minutes. A datetime without a tzinfo is assumed to be UTC.
+    """
+    delta = time.utcoffset()
+    if delta is None:
+        offset = 0
+    else:
+        offset = (delta.days * 86400 + delta.seconds) // 60
+    delta = time.replace(tzinfo=None) - EPOCH
+    return ((delta.days * 86400 + delta.seconds - offset * 60) * 1000000 +
+            delta.microseconds), offset
+
+
+def epoch_to_time(epoch, offset):
+    """Build the tz-aware datetime for an epoch and UTC offset in minutes"""
+    return (EPOCH + datetime.timedelta(microseconds=epoch + offset * 60000000)
+            ).replace(tzinfo=get_tz(offset))
 
 
 def extract_nodename(line, default_nodename):
@@ -0,0 +1,142 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+"""
+Watchers report the files that are ready to be picked up from a directory.
+
+The InotifyWatcher is told by the kernel when a file has been written and
+closed or moved into the directory, so new files are picked up straight
+away. Where inotify is not available the PollingWatcher lists the directory
+at an interval instead.
+
+Both report every file already in the directory on the first call to wait.
+The InotifyWatcher also lists the whole directory every RESCAN_INTERVAL
+seconds, so a file that could not be picked up when its event was seen, e.g.
+a zip that was still being copied, is tried again later.
+"""
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0x00080000
+
+# struct inotify_event, followed by a name of len bytes
+INOTIFY_EVENT = struct.Struct('iIII')
+
+READ_SIZE = 65536
+
+# Time between full listings of a directory watched with inotify
+RESCAN_INTERVAL = 15
+
+
+def list_directory(directory):
+    return [os.path.join(directory, file_name)
+            for file_name in os.listdir(directory)]
+
+
+class PollingWatcher(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.first = True
+
+    def wait(self, timeout):
+        """Return the files in the directory, waiting timeout seconds between
+        listings.
+        """
+        if self.first:
+            self.first = False
+        else:
+            time.sleep(timeout)
+        return list_directory(self.directory)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    def __init__(self, directory, rescan_interval=RESCAN_INTERVAL):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+
+        self.directory = directory
+        self.fd = inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if inotify_add_watch(self.fd, directory,
+                             IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e))
+        self.rescan_interval = rescan_interval
+        self.next_rescan = time.time()
+
+    def wait(self, timeout):
+        """Return the files written or moved into the directory, waiting up to
+        timeout seconds for there to be any, or every file in the directory
+        when a rescan is due.
+        """
+        if time.time() < self.next_rescan:
+            try:
+                readable, _, _ = select.select(
+                    [self.fd], [], [],
+                    max(0, min(timeout, self.next_rescan - time.time())))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            if readable:
+                return self.read_events()
+            if time.time() < self.next_rescan:
+                return []
+        return self.rescan()
+
+    def rescan(self):
+        self.next_rescan = time.time() + self.rescan_interval
+        return list_directory(self.directory)
+
+    def read_events(self):
+        """Return the files named by the waiting inotify events"""
+        data = os.read(self.fd, READ_SIZE)
+        file_names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            if mask & IN_Q_OVERFLOW:
+                # Events have been lost, fall back to a full listing
+                return self.rescan()
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if name:
+                file_names.append(os.path.join(self.directory, name))
+        return file_names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(directory):
+    """Return an InotifyWatcher for directory, or a PollingWatcher if inotify
+    cannot be used.
+    """
+    try:
+        return InotifyWatcher(directory)
+    except OSError:
+        logging.getLogger('timeline.watcher').warning(
+            'Unable to use inotify, polling {} instead'.format(directory),
+            exc_info=True)
+        return PollingWatcher(directory)
@@ -0,0 +1,122 @@
+import cgi
+import json
+
+"""
+Writers stream a Timeline out as text, JSON or HTML.
+
+Events are formatted and written a chunk at a time, so the output never has
+to be held in memory as a whole and the first events are written without
+waiting for the rest to be formatted.
+"""
+
+# Number of events formatted between each write
+CHUNK_SIZE = 4096
+
+# Number of events on each page of the HTML output
+PAGE_SIZE = 10000
+
+HTML_HEADER = """<style>
+  div.timelinetool {{
+    font-family: monospace;
+    padding: 10px;
+    color: #FFFFFF;
+    background-color: #000000;
+  }}
+  div.timelinetool table {{
+    border-collapse: collapse;
+    white-space: pre-wrap;
+  }}
+  div.timelinetool td {{
+    padding: 0 1em 0 0;
+    vertical-align: top;
+  }}
+  div.timelinetool td:nth-child(2) {{
+    text-align: center;
+  }}
+</style>
+<div class="timelinetool">
+<div class="pager">Page {page} of {pages}, events {first} to {last} of {total}
+</div>
+<table>
+"""
+
+HTML_ROW = '<tr><td>{}</td><td>{}</td><td>{}</td></tr>\n'
+
+HTML_FOOTER = """</table>
+</div>
+"""
+
+
+def node_width(events):
+    """Width of the node column, found from the distinct node names"""
+    names = set(event.node_name for event in events)
+    return max([len(name) + 4 for name in names] or [0])
+
+
+def chunked(events, size=CHUNK_SIZE):
+    for start in xrange(0, len(events), size):
+        yield events[start:start + size]
+
+
+def text_chunks(timeline):
+    timeline.sort()
+    width = node_width(timeline.events)
+    for chunk in chunked(timeline.events):
+        yield ''.join([event.format(width) + '\n' for event in chunk])
+
+
+def json_chunks(timeline):
+    timeline.sort()
+    yield '{"events": ['
+    separator = ''
+    for chunk in chunked(timeline.events):
+        yield separator + ', '.join([json.dumps(event.to_dict())
+                                     for event in chunk])
+        separator = ', '
+    yield ']}\n'
+
+
+def html_chunks(timeline, page_size=PAGE_SIZE, page=1):
+    """Render one page of page_size events as rows of a table. Only the rows
+    of that page are written, so however long the timeline, a browser only
+    has a page of it to load. Pages are numbered from 1, and a page past the
+    last is taken to be the last.
+    """
+    timeline.sort()
+    events = timeline.events
+    pages = max((len(events) + page_size - 1) // page_size, 1)
+    page = min(page, pages)
+    start = (page - 1) * page_size
+    events = events[start:start + page_size]
+    yield HTML_HEADER.format(page=page, pages=pages,
+                             first=start + 1 if events else 0,
+                             last=start + len(events),
+                             total=len(timeline.events))
+    # There are few nodes, so each is only escaped once
+    node_names = {}
+    for chunk in chunked(events):
+        rows = []
+        for event in chunk:
+            node_name = node_names.get(event.node_name)
+            if node_name is None:
+                node_name = node_names.setdefault(
+                    event.node_name, cgi.escape(event.node_name))
+            description = cgi.escape(event.full_description())
+            rows.append(HTML_ROW.format(event.timestamp.isoformat(),
+                                        node_name, description))
+        yield ''.join(rows)
+    yield HTML_FOOTER
+
+
+WRITERS = {'text': text_chunks,
+           'json': json_chunks,
+           'html': html_chunks}
+
+
+def write_timeline(timeline, output_format, out, **options):
+    """Write timeline to the file object out in output_format, options are
+    passed on to the writer for that format.
+    """
+    for chunk in WRITERS[output_format](timeline, **options):
+        out.write(chunk)
+    out.flush()